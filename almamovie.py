@@ -1,125 +1,60 @@
 import os
-import glob
 
 import argparse
 
 import warnings
 
-from astropy.io import fits
-from astropy.wcs import WCS
-
-import numpy as np
-
-import seaborn as sns
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
 from matplotlib import cm
 
-import imageio
+from cubeio import open_cube, channel_window
+from musemovie import MovieFrames, write_gif
 
 # Some things we'll be doing throw runtimewarnings that we won't care about.
 warnings.filterwarnings('ignore')
 
 
-def makeMovie(cube, name, thresh=None, scalefactor=3.0):
-    '''Make the movie'''
-
-    ########### READ THE DATA CUBE ####################
-    hdulist = fits.open(cube)
-
-    data = hdulist[0].data
-    header = hdulist[0].header
-
-    hdulist.close()
-
-    number_of_channels = len(data[0,:, 0, 0])
-
-    # This quick one liner finds the element in the wavelength array
-    # that is closest to the "target" wavelength, then returns that element's
-    # index.
-
-    # It finds the deviation between each array element and the target value,
-    # takes its absolute value, and then returns the index of
-    # the element with the smallest value in the resulting array.
-    # This is the number that is closest to the target.
-
-    movie_start = 0
-    movie_end = number_of_channels
-
-    slices_of_interest = np.arange(movie_start, movie_end, 1)
-
-    ########### CREATE AND SCRUB THE TEMPORARY FRAMESTORE ##############
-    temp_movie_dir = "framestore/"
-    if not os.path.exists(temp_movie_dir):
-        os.makedirs(temp_movie_dir)
-        print("Created a temporary directory called '{}', where movie frame .png files are stored. You can delete this afterward if you'd like.".format(temp_movie_dir))
-
-    png_files = []
-
-    # Clean the temporary movie directory first
-    # If you don't remove all "old" movie frames, your gif is gonna be messed up.
-    for f in glob.glob(temp_movie_dir + "*.png"):
-        os.remove(f)
-    #####################################################################
+def makeMovie(cube, name, thresh=None, scalefactor=3.0, stokes=0, freq=None, vel=None, linear=True, cmap=cm.viridis, background_color='white'):
+    '''Make the movie.
 
-    print("Making movie")
+    freq is a (low, high) range of frequencies in GHz, or vel a range of
+    radio velocities in km/s, to make the movie of; otherwise it's every
+    channel. stokes picks the Stokes plane, by index or as 'I', 'Q', 'U' or
+    'V'. Only those channels of that plane are ever read from the cube.
+    '''
 
-    for i, slice in enumerate(slices_of_interest):
+    data, header = open_cube(cube, stokes=stokes)
+    number_of_channels = data.shape[0]
 
-        final_image_data = data[0, slice, :, :]
+    if freq is not None:
+        window = channel_window(header, number_of_channels, freq[0], freq[1], unit='GHz')
+    elif vel is not None:
+        window = channel_window(header, number_of_channels, vel[0], vel[1], unit='km/s')
+    else:
+        window = (0, number_of_channels)
 
-        if thresh is not None:
-            final_image_data[final_image_data < thresh] = np.nan
+    movie = MovieFrames((data, header), None, window=window, thresh=thresh,
+                        scalefactor=scalefactor, cmap=cmap,
+                        background_color=background_color, linear=linear)
 
-        sizes = np.shape(final_image_data)
-        height = float(sizes[0]) * scalefactor
-        width = float(sizes[1]) * scalefactor
+    print("Making movie of channels {} to {} of {}".format(
+        window[0], window[1] - 1, number_of_channels))
 
-        fig = plt.figure()
-        fig.set_size_inches(width / height, 1, forward=False)
-        ax = plt.Axes(fig, [0., 0., 1., 1.])
-        ax.set_axis_off()
-        fig.add_axes(ax)
-
-        #cmap = sns.cubehelix_palette(20, light=0.95, dark=0.15, as_cmap=True)
-        cmap = cm.viridis
-        cmap.set_bad('white', 1)
-
-        ax.imshow(final_image_data, origin='lower', cmap=cmap, interpolation='None')     
-
-        fig.subplots_adjust(bottom=0)
-        fig.subplots_adjust(top=1)
-        fig.subplots_adjust(right=1)
-        fig.subplots_adjust(left=0)
-
-        fig.savefig(temp_movie_dir + '{}'.format(i) + '.png', dpi=height)
-        png_files.append(temp_movie_dir + '{}'.format(i) + '.png')
-        plt.close(fig)
-
-    ########### CREATE AND SCRUB THE GIF DIRECTORY ##############
     gif_output_dir = "movies/"
     if not os.path.exists(gif_output_dir):
         os.makedirs(gif_output_dir)
         print("Saving output movies to '{}'.".format(gif_output_dir))
-    #############################################################
 
     gif_name = gif_output_dir + '{}.gif'.format(name)
-    gif_frames = []
-
-    # Remove any old GIFs you might have made
-    if os.path.isfile(gif_name):
-        os.remove(gif_name)
-
-    for filename in png_files:
-        gif_frames.append(imageio.imread(filename))
 
-    imageio.mimsave(gif_name, gif_frames)
+    write_gif(movie, gif_name)
     print("Done. Saving movie to {}.".format(gif_name))
 
+    return movie
+
 
 def main():
 
-    parser = argparse.ArgumentParser(description='Make a movie of a MUSE cube')
+    parser = argparse.ArgumentParser(description='Make a movie of an ALMA cube')
 
     parser.add_argument('cube', help="the ALMA cube")
 
@@ -127,13 +62,27 @@ def main():
 
     parser.add_argument('-t', '--thresh', default=None, type=float)
 
+    parser.add_argument('-s', '--scalefactor', help="Factor by which to scale up the frames",
+                        default=3.0, type=float)
+
+    parser.add_argument('--freq', help="Only make the movie between these two frequencies, in GHz",
+                        nargs=2, type=float, default=None)
+
+    parser.add_argument('--vel', help="Only make the movie between these two radio velocities, in km/s (relative to the cube's rest frequency)",
+                        nargs=2, type=float, default=None)
+
+    parser.add_argument('--stokes', help="Stokes plane, as an index or I, Q, U or V",
+                        default='0')
+
+    parser.add_argument('--log', help="Use a log stretch rather than a linear one",
+                        default=False, action='store_true')
+
     args = parser.parse_args()
 
-    cube = args.cube    
-    name = args.name
-    thresh = args.thresh
+    stokes = int(args.stokes) if args.stokes.isdigit() else args.stokes
 
-    makeMovie(cube, name, thresh)
+    makeMovie(args.cube, args.name, thresh=args.thresh, scalefactor=args.scalefactor,
+              stokes=stokes, freq=args.freq, vel=args.vel, linear=not args.log)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import argparse
+
+from astropy import units as u
+
+from astroquery.ned import Ned
+
+import numpy as np
+
+from matplotlib import cm
+
+from musemovie import MovieFrames, write_gif, write_moment_maps
+from framecache import RenderCache
+from gallery import Gallery
+from catalog import RedshiftCatalog, load_aliases, construct_filename_dictionaries, load_redshift_cache, save_redshift_cache
+from planner import plan_batch, print_plan
+from pipeline import prefetch
+from watch import DirectoryWatcher
+
+
+def parse_batch_arguments():
+    '''The command line options every batch script takes'''
+
+    parser = argparse.ArgumentParser(description='Make movies of every science cube in the MUSE data directory')
+    parser.add_argument('--watch', help="After the first pass, keep watching the data directory and make movies of new or changed cubes as they arrive",
+                        default=False, action='store_true')
+    parser.add_argument('--interval', help="Seconds between directory scans in watch mode (and how long a new file must stay the same size)",
+                        type=float, default=30.0)
+    parser.add_argument('--plan', help="Don't make anything: read the headers, check every job and estimate what it will cost",
+                        default=False, action='store_true')
+    parser.add_argument('--memory', help="Memory budget, in GB: limits how many cubes are read ahead, and what --plan packs jobs into",
+                        type=float, default=8.0)
+
+    return parser.parse_args()
+
+
+def run_batch(args, muse_data_directory, movie_working_directory, line_restwav=6563, scalefactor=2.0, cmap=cm.plasma, background_color='black', thresh=None, numframes=30, redshift_cache=None, redshift_catalog=None, moments=False, find_line=False, gallery=False, gallery_tile=200, gallery_velocity_grid=(-1500, 1500, 50), prefetch_depth=1, render_cache_dir=None, precision='float32', overwrite=False, redshift_id_only=False):
+    '''Make a movie of every science cube in muse_data_directory, in
+    movie_working_directory/movies/, with the batch scripts' settings (see
+    make_hamer_movies.py for what each one does) and parse_batch_arguments'
+    options'''
+
+    if redshift_cache is None:
+        redshift_cache = os.path.join(movie_working_directory, 'redshifts.json')
+
+    # Anything in the directory now is handled by the first pass, and only
+    # what arrives after that by watch mode
+    if args.watch is True:
+        watcher = DirectoryWatcher(muse_data_directory, interval=args.interval)
+
+    if redshift_catalog is not None:
+        catalog = RedshiftCatalog(redshift_catalog)
+        aliases = catalog.aliases
+    else:
+        catalog = None
+        aliases = load_aliases()
+
+    # A plan lists bad files rather than stopping at the first one
+    failures = {} if args.plan is True else None
+    name_dictionary, coordinate_dictionary = construct_filename_dictionaries(muse_data_directory, aliases, failures=failures)
+
+    if catalog is not None:
+        redshift_dictionary = catalog.resolve(coordinate_dictionary)
+    else:
+        redshift_dictionary = load_redshift_cache(redshift_cache)
+        unresolved = {cube: name for cube, name in name_dictionary.items() if name not in redshift_dictionary}
+        # Plans never go to the network
+        if len(unresolved) > 0 and args.plan is not True:
+            redshift_dictionary.update(query_ned_for_redshifts(unresolved, coordinate_dictionary))
+            save_redshift_cache(redshift_cache, redshift_dictionary)
+
+    emission_line_center_dictionary = map_linecenters(redshift_dictionary, line_restwav)
+
+    # Targets at different redshifts only line up in a gallery on a
+    # shared velocity grid; the channels are different widths in km/s
+    velocity_grid = gallery_velocity_grid if gallery is True else None
+
+    settings = dict(numframes=numframes,
+                    scalefactor=scalefactor,
+                    thresh=thresh,
+                    cmap=cmap,
+                    background_color=background_color,
+                    logscale=True,
+                    contsub=True,
+                    find_line=find_line,
+                    precision=precision,
+                    velocity_grid=velocity_grid)
+
+    # Check every job against its cube's header up front, so bad ones are
+    # skipped now rather than failing after their data is read. The plan
+    # is drawn from the same settings as the render, so the two agree.
+    plan_options = dict(frames=settings['numframes'], scalefactor=settings['scalefactor'],
+                        contsub=settings['contsub'], slab=True, precision=settings['precision'],
+                        velocity_grid=settings['velocity_grid'])
+    jobs = plan_batch(name_dictionary, redshift_dictionary, line_restwav, failures=failures,
+                      **plan_options)
+
+    if args.plan is True:
+        print_plan(jobs, memory_limit=args.memory * 1e9)
+        return
+
+    if overwrite is True:
+        print("Movie directory overwrite is TRUE.")
+        existing_gifs = glob.glob(os.path.join(movie_working_directory, "movies/*.gif"))
+        if len(existing_gifs) > 0:
+            print("Existing GIFs found. Scrubbing them.")
+        elif len(existing_gifs) == 0:
+            print("Movie directory is clean, nothing to remove.")  
+        for gif in existing_gifs:
+            print("Removing {}.".format(gif))
+            os.remove(gif)
+
+    settings['render_cache'] = RenderCache(render_cache_dir) if render_cache_dir is not None else None
+
+    def load(job):
+        return loadMovie(job.cube, emission_line_center_dictionary[job.name], **settings)
+
+    def render(cube, name, movie=None):
+        return makeMovie(movie_working_directory,
+                         cube,
+                         name,
+                         redshift_dictionary[name],
+                         emission_line_center_dictionary[name],
+                         moments=moments,
+                         movie=movie,
+                         **settings
+                         )
+
+    if redshift_id_only is not True: 
+        for job in jobs:
+            if len(job.problems) > 0:
+                print("Skipping movie for {}: {}".format(job.name, "; ".join(job.problems)))
+        good_jobs = [job for job in jobs if len(job.problems) == 0]
+
+        # Besides the cube rendering, the reader holds one and depth more
+        # wait in its queue, so only read as far ahead as the biggest job
+        # allows within --memory
+        depth = prefetch_depth
+        if len(good_jobs) > 0:
+            fit = int(args.memory * 1e9 // max(job.peak_bytes for job in good_jobs))
+            depth = max(0, min(prefetch_depth, fit - 2))
+            if depth < prefetch_depth:
+                print("Reading {} cubes ahead rather than {}, to stay within {} GB.".format(
+                    depth, prefetch_depth, args.memory))
+
+        if gallery is True:
+            grid = Gallery(len(good_jobs), tile=gallery_tile, background_color=background_color)
+
+        # The next cube is read in the background while this one renders
+        for job, movie in prefetch(good_jobs, load, depth=depth):
+            render(job.cube, job.name, movie=movie)
+            # Each movie goes into the gallery as soon as it's made, so only
+            # the few cubes in the prefetch queue are ever in memory
+            if gallery is True:
+                grid.add(movie, job.name)
+
+        if gallery is True and len(grid) > 0:
+            gallery_name = os.path.join(movie_working_directory, "movies/gallery.gif")
+            print("\nMaking a gallery of {} targets.".format(len(grid.names)))
+            write_gif(grid, gallery_name)
+            print("Done. Saved to {}.".format(gallery_name))
+
+        if args.watch is True:
+            print("\nWatching {} for new cubes. Ctrl-C to stop.".format(muse_data_directory))
+
+            # Only the new or changed files' headers are read. A bad file is
+            # skipped, rather than ending the watch.
+            for filelist in watcher:
+                new_failures = {}
+                new_names, new_coordinates = construct_filename_dictionaries(
+                    muse_data_directory, aliases, filelist=filelist, failures=new_failures)
+
+                if catalog is not None:
+                    redshift_dictionary.update(catalog.resolve(new_coordinates))
+                else:
+                    # NED is only asked about targets it hasn't already found
+                    unresolved = {cube: name for cube, name in new_names.items() if name not in redshift_dictionary}
+                    if len(unresolved) > 0:
+                        try:
+                            redshift_dictionary.update(query_ned_for_redshifts(unresolved, new_coordinates))
+                            save_redshift_cache(redshift_cache, redshift_dictionary)
+                        except Exception as error:
+                            print("Couldn't get redshifts from NED: {}".format(error))
+
+                emission_line_center_dictionary = map_linecenters(redshift_dictionary, line_restwav)
+
+                new_jobs = plan_batch(new_names, redshift_dictionary, line_restwav, failures=new_failures,
+                                      **plan_options)
+                for job in new_jobs:
+                    if len(job.problems) > 0:
+                        print("Skipping movie for {}: {}".format(job.name or job.cube, "; ".join(job.problems)))
+                        continue
+                    try:
+                        render(job.cube, job.name)
+                    except Exception as error:
+                        print("Couldn't make the movie for {}: {}".format(job.name, error))
+
+
+def map_linecenters(redshift_dictionary, line_restwav):
+
+    # Instantiate the dictionary
+    emission_line_center_dictionary = {}
+
+    for name, z in redshift_dictionary.items():
+        emission_line_center_dictionary["{}".format(name)] = line_restwav * (1 + z)
+
+    print("Desired emission line ({} Angstroms) redshifted for all targets.".format(line_restwav))
+
+    return emission_line_center_dictionary
+
+def query_ned_for_redshifts(name_dictionary, coordinate_dictionary):
+    '''Query NED for redshifts based on target names'''
+
+    print("\n\n =========== FINDING REDSHIFTS ========\n")
+    # Instantiate an empty dictionary for redshifts
+    redshift_dictionary = {}
+    continued_failures = []
+
+    target_names = name_dictionary.values()
+
+    for name in target_names:
+        try:
+            z = Ned.query_object(name)["Redshift"][0]
+            redshift_dictionary["{}".format(name)] = z
+            print("The NED redshift for {} is {}.".format(name, z))
+        except:
+            print("Cannot resolve redshift using NAME {}, trying coordinate search.".format(name))
+            z = Ned.query_region(coordinate_dictionary[name], radius=20 * u.arcsec, equinox='J2000.0')["Redshift"][0]
+            # If this fails, it will silently set Z to a numpy.ma MaskedConstant (looks like '--')
+            if np.ma.is_masked(z) is True:
+                continued_failures.append(name)
+                print("Still cannot find a redshift for {}, skipping it.".format(name))
+            elif z < 1.0: # none of these sources are high redshift, this is a dumb sanity check:
+                redshift_dictionary["{}".format(name)] = z
+                print("{} is at RA={}, Dec={}. NED finds a redshift of {}.".format(name, coordinate_dictionary[name].ra, coordinate_dictionary[name].dec, z))
+
+    if len(continued_failures) > 0:
+        print("You need to manually fix these, which still cannot be resolved: ", continued_failures)
+        print("In the meantime, they'll be skipped by the movie maker.")
+    elif len(continued_failures) == 0:
+        print("It SEEMS like all redshifts have successfully been found, ")
+
+    print("Here are your (hopefully) successful redshift identifications - check these!")
+    print("                  NAME = Z")
+    for name, z in redshift_dictionary.items():
+        print("               {} = {}".format(name, z))
+
+    return redshift_dictionary
+
+
+
+def loadMovie(cube, center, numframes=30, scalefactor=2.0, cmap=cm.plasma, background_color='black', thresh=None, logscale=False, contsub=False, find_line=False, render_cache=None, precision='float32', velocity_grid=None):
+    '''Open a movie, and read every channel it needs into memory'''
+
+    # The dumb continuum subtraction also blanks anything fainter than 0.005
+    movie = MovieFrames(cube, center, frames=numframes, thresh=thresh,
+                        scalefactor=scalefactor, contsub=contsub,
+                        contsub_floor=0.005, cmap=cmap,
+                        background_color=background_color,
+                        linear=not logscale, find_line=find_line,
+                        render_cache=render_cache, precision=precision,
+                        velocity_grid=velocity_grid)
+    movie.load()
+
+    return movie
+
+
+def makeMovie(workingdir, cube, name, redshift, center, numframes=30, scalefactor=2.0, cmap=cm.plasma, background_color='black', thresh=None, logscale=False, contsub=False, find_line=False, moments=False, render_cache=None, precision='float32', velocity_grid=None, movie=None):
+    '''Make the movie. movie is the loadMovie of the cube, if it's been
+    loaded already (by a prefetcher, say).'''
+
+    if movie is None:
+        movie = loadMovie(cube, center, numframes=numframes, scalefactor=scalefactor,
+                          cmap=cmap, background_color=background_color, thresh=thresh,
+                          logscale=logscale, contsub=contsub, find_line=find_line,
+                          render_cache=render_cache, precision=precision,
+                          velocity_grid=velocity_grid)
+
+    if find_line is True:
+        restwav = center / (1 + redshift)
+        redshift = movie.center / restwav - 1
+        print("Found the line for {} at {} Angstroms (expected {}), which implies z={}".format(
+            name, round(movie.center, 2), round(center, 2), round(redshift, 5)))
+
+    print("\nMaking movie for {} at z={}. Line centroid is in channel {}.".format(
+        name, round(redshift, 3), movie.center_channel))
+
+    # Create the GIF directory
+    gif_output_dir = workingdir + "movies/"
+    if not os.path.exists(gif_output_dir):
+        os.makedirs(gif_output_dir)
+        print("Saving output movies to '{}'.".format(gif_output_dir))
+
+    # Set the GIF filenames
+    i = 0
+
+    # Check if that gif name already exists:
+    while os.path.exists(gif_output_dir + '{}_{}.gif'.format(name, i)):
+        i += 1
+    
+    gif_name = gif_output_dir + '{}_{}.gif'.format(name.replace(' ', '-'), i)
+
+    write_gif(movie, gif_name)
+    print("Done. Saved to {}.".format(gif_name))
+
+    if moments is True:
+        write_moment_maps(movie, gif_name[:-len('.gif')], cmap=cmap)
+
+    return movie
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+
+class Binning(object):
+    '''A spatial tessellation of the field into bins.
+
+    index maps every (y, x) pixel to its bin, or -1 for pixels that aren't
+    in any bin. Applying the binning replaces every pixel with the mean of
+    its bin, for one image or a whole (channels, y, x) stack at once, with
+    one bincount (gather) and one fancy index (scatter).
+    '''
+
+    def __init__(self, index):
+
+        # Renumber so the bins are 0..nbins-1 with no gaps
+        valid = index >= 0
+        labels, renumbered = np.unique(index[valid], return_inverse=True)
+
+        self.index = np.full(index.shape, -1, dtype=np.intp)
+        self.index[valid] = renumbered
+        self.nbins = len(labels)
+
+        self._flat = self.index.ravel()
+        self._valid = self._flat >= 0
+
+    def _sums(self, images):
+        '''Per-bin sums and counts of the finite pixels of each image'''
+
+        stack = images.reshape(-1, self._flat.size)[:, self._valid]
+        finite = np.isfinite(stack)
+
+        # Offset each image's bins so they can all go through one bincount
+        offsets = np.arange(len(stack))[:, np.newaxis] * self.nbins
+        bins = (self._flat[self._valid][np.newaxis, :] + offsets)[finite]
+
+        length = len(stack) * self.nbins
+        sums = np.bincount(bins, weights=stack[finite], minlength=length)
+        counts = np.bincount(bins, minlength=length)
+
+        return sums.reshape(len(stack), self.nbins), counts.reshape(len(stack), self.nbins)
+
+    def _scatter(self, values, images):
+
+        out = np.full(images.reshape(-1, self._flat.size).shape, np.nan,
+                      dtype=np.float32)
+        out[:, self._valid] = values[:, self._flat[self._valid]]
+
+        return out.reshape(images.shape)
+
+    def apply(self, images):
+        '''Replace each pixel by the mean of its bin'''
+
+        sums, counts = self._sums(images)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+
+        return self._scatter(means, images)
+
+    def apply_variance(self, variance):
+        '''The variance of each pixel's bin mean'''
+
+        sums, counts = self._sums(variance)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance_of_mean = sums / counts ** 2
+
+        return self._scatter(variance_of_mean, variance)
+
+
+def quadtree_bins(signal, variance, target_snr):
+    '''Quadtree binning of a (y, x) signal map toward a target S/N.
+
+    Starting from one square covering the field, a square is split into
+    quarters as long as its S/N is at least twice the target, so that for
+    smooth emission each quarter still reaches the target on its own. The
+    whole tree is worked out a level at a time with summed-area tables, so
+    every square at a level is tested at once. Returns a Binning.
+    '''
+
+    ny, nx = signal.shape
+    valid = np.isfinite(signal) & np.isfinite(variance) & (variance > 0)
+
+    size = 1
+    while size < max(ny, nx):
+        size *= 2
+
+    # Summed-area tables of signal, variance and valid pixels, padded out to
+    # the square
+    tables = []
+    for plane in (np.where(valid, signal, 0.0), np.where(valid, variance, 0.0), valid):
+        padded = np.zeros((size + 1, size + 1))
+        padded[1:ny + 1, 1:nx + 1] = plane
+        tables.append(padded.cumsum(axis=0).cumsum(axis=1))
+
+    def box(table, y, x, s):
+        return table[y + s, x + s] - table[y, x + s] - table[y + s, x] + table[y, x]
+
+    index = np.full((size, size), -1, dtype=np.intp)
+    next_label = 0
+
+    y = np.array([0])
+    x = np.array([0])
+    s = size
+
+    while len(y) > 0:
+        # Squares with no data at all are dropped
+        has_data = box(tables[2], y, x, s) > 0
+        y = y[has_data]
+        x = x[has_data]
+
+        if s > 1:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                snr = box(tables[0], y, x, s) / np.sqrt(box(tables[1], y, x, s))
+            ok = snr >= 2 * target_snr
+        else:
+            ok = np.zeros(len(y), dtype=bool)
+
+        # Squares that don't split become bins. Paint them all in at once,
+        # at this level's resolution, then blow that up to full size.
+        leaves = ~ok
+        if leaves.any():
+            level = np.full((size // s, size // s), -1, dtype=np.intp)
+            level[y[leaves] // s, x[leaves] // s] = next_label + np.arange(leaves.sum())
+            next_label += leaves.sum()
+            painted = np.repeat(np.repeat(level, s, axis=0), s, axis=1)
+            index = np.where(painted >= 0, painted, index)
+
+        if s == 1:
+            break
+
+        half = s // 2
+        y = np.concatenate([y[ok], y[ok] + half, y[ok], y[ok] + half])
+        x = np.concatenate([x[ok], x[ok], x[ok] + half, x[ok] + half])
+        s = half
+
+    index = index[:ny, :nx]
+    index[~valid] = -1
+
+    return Binning(index)
+
+
+def voronoi_bins(signal, variance, target_snr, iterations=5):
+    '''Voronoi binning of a (y, x) signal map toward a target S/N.
+
+    The quadtree bins are used as generators, then moved a few times to the
+    (S/N)^2-weighted centroids of their Voronoi cells (Lloyd's algorithm),
+    which gives rounder bins that still shrink where the S/N is high. Each
+    step is one KD-tree query and a few bincounts over the pixels. Returns
+    a Binning.
+    '''
+
+    from scipy.spatial import cKDTree
+
+    valid = np.isfinite(signal) & np.isfinite(variance) & (variance > 0)
+
+    ys, xs = np.nonzero(valid)
+    if len(ys) == 0:
+        return Binning(np.full(signal.shape, -1, dtype=np.intp))
+
+    weights = np.clip(signal[valid], 0, None) ** 2 / variance[valid]
+    # Don't let empty sky drop out of the centroids entirely
+    weights += 1e-6 * (weights.max() if weights.max() > 0 else 1.0)
+
+    bins = quadtree_bins(signal, variance, target_snr).index[valid]
+
+    for iteration in range(iterations + 1):
+        nbins = bins.max() + 1
+        total = np.bincount(bins, weights=weights, minlength=nbins)
+        keep = total > 0
+        generators = np.column_stack([
+            np.bincount(bins, weights=weights * ys, minlength=nbins)[keep] / total[keep],
+            np.bincount(bins, weights=weights * xs, minlength=nbins)[keep] / total[keep]])
+
+        _, bins = cKDTree(generators).query(np.column_stack([ys, xs]))
+
+    index = np.full(signal.shape, -1, dtype=np.intp)
+    index[ys, xs] = bins
+
+    return Binning(index)
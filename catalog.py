@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import csv
+import glob
+import json
+
+from astropy.io import fits
+from astropy.table import Table
+from astropy import units as u
+from astropy import coordinates
+
+import numpy as np
+
+# Maps the OBJECT names in ESO archive headers to names NED (or a catalog)
+# knows them by.
+DEFAULT_ALIASES = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'name_aliases.csv')
+
+
+def normalize_name(name):
+    '''Case- and whitespace-insensitive key for matching target names'''
+    return ''.join(name.lower().split())
+
+
+def load_aliases(filename=DEFAULT_ALIASES):
+    '''Read an alias,name CSV into a dictionary of alias -> name'''
+
+    aliases = {}
+    with open(filename) as f:
+        for row in csv.DictReader(f):
+            aliases[row['alias'].strip()] = row['name'].strip()
+
+    return aliases
+
+
+def construct_filename_dictionaries(muse_data_directory, name_corrections, filelist=None, failures=None):
+    '''Map ESO archive filenames to target names.
+
+    By default every .fits file in the directory is mapped; pass filelist
+    to only map those files (like new arrivals in watch mode). A file
+    without RA/Dec (or a readable header and OBJECT) stops everything,
+    unless failures is a dictionary, in which case it's recorded there as
+    {filename: reason} and skipped.
+    '''
+
+    print("\n\n ===== MAPPING FILENAMES TO TARGET NAMES ====\n")
+    # Create a simple list of the fits filenames
+    if filelist is None:
+        filelist = glob.glob(muse_data_directory + "*.fits")
+    print("MUSE directory set to {}".format(muse_data_directory))
+
+    # Instantiate a dictionary we'll use to map filenames to target names
+    name_dictionary = {}
+    coordinate_dictionary = {}
+
+    # If these substrings are found in target_name,
+    # it won't be a real science datacube, so we're gonna skip that file.
+    red_flags = ["(white)", "SKY_"]
+    skipped_files = []
+
+    # Loop through the cubelist, skipping white light 2D images
+    for fitsfile in filelist:
+        try:
+            hdr = fits.getheader(fitsfile)
+            target_name = hdr['OBJECT']
+        except (OSError, KeyError) as error:
+            if failures is None:
+                raise
+            failures[fitsfile] = "can't read the header: {}".format(error)
+            continue
+
+        if target_name in name_corrections:
+            corrected_target_name = name_corrections[target_name]
+            print("Renaming {} to {}".format(target_name, corrected_target_name))
+            target_name = corrected_target_name
+
+        try:
+            ra = hdr['RA']
+            dec = hdr['DEC']
+        except KeyError:
+            if failures is not None:
+                failures[fitsfile] = "no RA/Dec in header (target = {})".format(target_name)
+                continue
+            sys.exit("File {} (target = {}) doesn't have RA/Dec in header. Please fix or remove.".format(fitsfile,target_name))
+
+        if any(flag in target_name for flag in red_flags):
+            skipped_files.append(fitsfile.split("/")[-1])
+        else:
+            name_dictionary["{}".format(fitsfile)] = target_name
+            coordinate_dictionary["{}".format(target_name)] = coordinates.SkyCoord(ra=ra, dec=dec, frame='fk5', unit=(u.deg, u.deg))
+            print("{} is {}".format(fitsfile.split("/")[-1], target_name))
+
+    print("Skipped {} files because they were WHITELIGHT or SKY images.".format(len(skipped_files)))
+
+    return name_dictionary, coordinate_dictionary
+
+
+def load_redshift_cache(filename):
+    '''Redshifts found on earlier runs, as {name: z}'''
+
+    if not os.path.isfile(filename):
+        return {}
+
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_redshift_cache(filename, redshift_dictionary):
+    '''Add redshifts to the cache, so later runs (and plans) don't need NED'''
+
+    cache = load_redshift_cache(filename)
+    cache.update({name: float(z) for name, z in redshift_dictionary.items()})
+
+    with open(filename, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+class RedshiftCatalog(object):
+    '''Resolve target redshifts from a local catalog, with no network.
+
+    The catalog is a CSV or FITS table with name, ra, dec (in degrees) and z
+    columns, and optionally an aliases column of ';'-separated other names.
+    It is loaded and indexed once: a dictionary for names and aliases, and a
+    KD-tree over the coordinates that astropy builds on the first match and
+    keeps for every match after that.
+    '''
+
+    def __init__(self, filename, aliases=DEFAULT_ALIASES, radius=20 * u.arcsec):
+
+        table = Table.read(filename)
+        columns = {c.lower(): c for c in table.colnames}
+
+        self.names = [str(n).strip() for n in table[columns['name']]]
+        self.redshifts = np.ma.filled(
+            np.ma.asarray(table[columns['z']], dtype=float), np.nan)
+        self.coords = coordinates.SkyCoord(ra=np.asarray(table[columns['ra']], dtype=float),
+                                           dec=np.asarray(
+                                               table[columns['dec']], dtype=float),
+                                           unit=(u.deg, u.deg))
+        self.radius = radius
+
+        # Header names -> catalog names. The default alias file covers the
+        # ESO archive's shorthand; the catalog can add its own.
+        self.aliases = load_aliases(aliases) if aliases is not None else {}
+
+        self._rows = {}
+        for row, name in enumerate(self.names):
+            self._rows[normalize_name(name)] = row
+
+        if 'aliases' in columns:
+            for row, other_names in enumerate(table[columns['aliases']]):
+                if np.ma.is_masked(other_names):
+                    continue
+                for alias in str(other_names).split(';'):
+                    if alias.strip():
+                        self._rows.setdefault(normalize_name(alias), row)
+
+        for alias, name in self.aliases.items():
+            if normalize_name(name) in self._rows:
+                self._rows.setdefault(normalize_name(alias),
+                                      self._rows[normalize_name(name)])
+
+    def resolve(self, coordinate_dictionary):
+        '''Find redshifts for a {name: SkyCoord} dictionary of targets.
+
+        Targets are looked up by name (or alias) first. Everything left over
+        is matched by position in a single vectorized call, and accepted if
+        the nearest catalog source is within the search radius.
+        '''
+
+        print("\n\n =========== FINDING REDSHIFTS (LOCAL CATALOG) ========\n")
+
+        redshift_dictionary = {}
+        unmatched = []
+
+        for name in coordinate_dictionary:
+            row = self._rows.get(normalize_name(name))
+            if row is not None and np.isfinite(self.redshifts[row]):
+                redshift_dictionary["{}".format(name)] = float(self.redshifts[row])
+                print("The catalog redshift for {} is {}.".format(
+                    name, self.redshifts[row]))
+            else:
+                unmatched.append(name)
+
+        continued_failures = []
+
+        if len(unmatched) > 0:
+            targets = coordinates.SkyCoord([coordinate_dictionary[name] for name in unmatched])
+            rows, separations, _ = targets.match_to_catalog_sky(self.coords)
+
+            for name, row, separation in zip(unmatched, rows, separations):
+                z = float(self.redshifts[row])
+                if separation <= self.radius and np.isfinite(z):
+                    redshift_dictionary["{}".format(name)] = z
+                    print("{} matches catalog source {} ({} away), at z={}.".format(
+                        name, self.names[row], separation.to(u.arcsec).round(2), z))
+                else:
+                    continued_failures.append(name)
+
+        if len(continued_failures) > 0:
+            print("No catalog redshift within {} for these, they'll be skipped: ".format(
+                self.radius), continued_failures)
+
+        return redshift_dictionary
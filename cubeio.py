@@ -0,0 +1,692 @@
+#!/usr/bin/env python
+
+import os
+import re
+import gzip
+import json
+import hashlib
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+import numpy as np
+
+# Converted cubes are written as HDF5 stores with these extensions.
+STORE_EXTENSIONS = ('.h5', '.hdf5')
+
+# Default (channel, y, x) chunk shape for converted stores. A chunk is ~256 kB
+# of float32, so a 60-channel movie slab touches one or two chunk planes while
+# a single-pixel spectrum of a ~3700-channel MUSE cube only touches ~60 chunks.
+DEFAULT_CHUNKS = (64, 32, 32)
+
+# How many channels below the line the dumb continuum subtraction takes
+# its continuum channel from
+CONTINUUM_OFFSET = 200
+
+# Speed of light in km/s, for velocity offsets from the line center
+C_KMS = 299792.458
+
+# Stokes parameters by their FITS STOKES axis values
+STOKES_CODES = {'I': 1, 'Q': 2, 'U': 3, 'V': 4}
+
+
+def is_store(cube):
+    '''Is this path a converted (chunked, compressed) cube store?'''
+    return os.path.splitext(cube)[1].lower() in STORE_EXTENSIONS
+
+
+def open_cube(cube, cache_dir=None, stokes=0):
+    '''Open a FITS cube or a converted store.
+
+    Returns (data, header). The data is only read from disk when it is
+    sliced, so take channel slabs (data[start:stop]) rather than the whole
+    thing. Tile-compressed (.fz) cubes only decompress the tiles that cover
+    each slice. If cache_dir is set, gzipped cubes are decompressed into it
+    once and memory-mapped from there on later runs. 4D radio cubes (like
+    ALMA's) come back as the (channels, y, x) cube of one Stokes plane, see
+    select_stokes.
+    '''
+
+    if is_store(cube):
+        import h5py
+
+        store = h5py.File(cube, 'r')
+        data = store['data']
+        header = fits.Header.fromstring(data.attrs['header'])
+
+        return data, header
+
+    if cache_dir is not None and cube.endswith('.gz'):
+        cube = gunzip_to_cache(cube, cache_dir)
+
+    hdulist = fits.open(cube, memmap=True)
+
+    hdu = hdulist[0]
+
+    # Most pipeline cubes will have data in 1st extension.
+    # Check the header rather than the data, so nothing gets read (or
+    # decompressed) yet.
+    if hdu.header.get('NAXIS', 0) == 0:
+        hdu = hdulist[1]
+
+    header = hdu.header
+
+    if isinstance(hdu, fits.CompImageHDU):
+        # Slicing the section decompresses only the tiles it covers, so the
+        # file has to stay open.
+        return hdu.section, header
+
+    data = hdu.data
+
+    hdulist.close()
+
+    if header.get('NAXIS') == 4:
+        return select_stokes(data, header, stokes)
+
+    return data, header
+
+
+def select_stokes(data, header, stokes=0):
+    '''The (channels, y, x) cube of one Stokes plane of a 4D radio cube.
+
+    stokes is an index along the Stokes axis, or 'I', 'Q', 'U' or 'V'. The
+    Stokes axis can be the 3rd or 4th FITS axis (it's found by its CTYPE);
+    the spectral axis is the other one. The data is a view, so a memory
+    mapped cube still only reads the channels that are sliced. The header
+    comes back with a 3D WCS, the spectral axis as axis 3.
+    '''
+
+    ctypes = [header.get('CTYPE{}'.format(axis), '').strip().upper() for axis in (1, 2, 3, 4)]
+    stokes_axis = ctypes.index('STOKES') + 1 if 'STOKES' in ctypes else 4
+    spectral_axis = 7 - stokes_axis
+
+    if isinstance(stokes, str):
+        number = header['NAXIS{}'.format(stokes_axis)]
+        values = ((np.arange(number) + 1.0 - header.get('CRPIX{}'.format(stokes_axis), 1.0)) *
+                  header.get('CDELT{}'.format(stokes_axis), 1.0) +
+                  header.get('CRVAL{}'.format(stokes_axis), 1.0))
+        matches = np.flatnonzero(values == STOKES_CODES[stokes.upper()])
+        if len(matches) == 0:
+            raise ValueError("This cube has no Stokes {} plane.".format(stokes))
+        stokes = int(matches[0])
+
+    # numpy axes run backwards from FITS axes. Taking one Stokes plane
+    # leaves the spectral axis first either way.
+    index = [slice(None)] * 4
+    index[4 - stokes_axis] = stokes
+    data = data[tuple(index)]
+
+    # Rebuild the header around a 3D WCS of RA, Dec and the spectral axis
+    wcs_header = WCS(header).sub([1, 2, spectral_axis]).to_header()
+    header = header.copy()
+    for key in list(header.keys()):
+        if (re.match(r'^(CTYPE|CRVAL|CDELT|CRPIX|CUNIT|CROTA|NAXIS)[34]$', key) or
+                re.match(r'^(PC|CD)0*\d+_0*\d+$', key)):
+            del header[key]
+    header.update(wcs_header)
+    header['NAXIS'] = 3
+    header['NAXIS3'] = data.shape[0]
+
+    return data, header
+
+
+def read_header(cube):
+    '''The (channels, y, x) shape, bytes per pixel and header of a cube,
+    without reading any of its data'''
+
+    if is_store(cube):
+        import h5py
+
+        with h5py.File(cube, 'r') as store:
+            data = store['data']
+            return data.shape, data.dtype.itemsize, fits.Header.fromstring(data.attrs['header'])
+
+    with fits.open(cube, memmap=True) as hdulist:
+        hdu = hdulist[0]
+        if hdu.header.get('NAXIS', 0) == 0:
+            hdu = hdulist[1]
+        header = hdu.header.copy()
+
+    shape = (header['NAXIS3'], header['NAXIS2'], header['NAXIS1'])
+
+    return shape, abs(header['BITPIX']) // 8, header
+
+
+def open_variance(cube, cache_dir=None):
+    '''Open the STAT (variance) extension that pipeline cubes carry next to DATA.
+
+    Like open_cube, the variance is only read from disk when it's sliced,
+    so you can take just the channels you need.
+    '''
+
+    if is_store(cube):
+        import h5py
+
+        store = h5py.File(cube, 'r')
+        if 'stat' not in store:
+            raise ValueError("{} was converted without a STAT extension.".format(cube))
+
+        return store['stat']
+
+    if cache_dir is not None and cube.endswith('.gz'):
+        cube = gunzip_to_cache(cube, cache_dir)
+
+    hdulist = fits.open(cube, memmap=True)
+
+    if 'STAT' not in hdulist:
+        raise ValueError("{} has no STAT extension to get the noise from.".format(cube))
+
+    hdu = hdulist['STAT']
+
+    if isinstance(hdu, fits.CompImageHDU):
+        return hdu.section
+
+    variance = hdu.data
+
+    hdulist.close()
+
+    return variance
+
+
+def wavelength_array(header, number_of_channels):
+    '''Wavelength of every channel in the cube, from its spectral WCS.
+
+    For radio cubes, this is the frequency or velocity of every channel
+    instead, in the units of the header (see CTYPE3 and CUNIT3).
+    '''
+
+    if 'CD3_3' in header:
+        step = header['CD3_3']
+    else:
+        step = header['CDELT3'] * header.get('PC3_3', 1.0)
+
+    wavelength = ((np.arange(number_of_channels) + 1.0) -
+                  header['CRPIX3']) * step + header['CRVAL3']
+
+    return wavelength
+
+
+def velocity_array(header, wavelength, center=None):
+    '''Velocity, in km/s, of every channel of a cube.
+
+    For optical cubes, it's the offset from the line at center (in the same
+    units as the wavelengths). For radio cubes with a frequency axis it's the
+    radio velocity relative to center, or to the header's rest frequency if
+    center isn't given. Radio cubes with a velocity axis give it as it is.
+    '''
+
+    ctype = header.get('CTYPE3', '').upper()
+
+    if ctype.startswith('FREQ'):
+        rest = center if center is not None else header.get('RESTFRQ', header.get('RESTFREQ'))
+        return C_KMS * (rest - wavelength) / rest
+    elif ctype.startswith(('VRAD', 'VELO', 'VOPT')):
+        scale = 1e-3 if header.get('CUNIT3', 'm/s').strip().lower() == 'm/s' else 1.0
+        return wavelength * scale
+
+    return C_KMS * (wavelength - center) / center
+
+
+def channel_window(header, number_of_channels, low, high, unit='GHz'):
+    '''The (start, stop) channels of a radio cube between two frequencies
+    (unit='GHz') or radio velocities (unit='km/s').
+
+    Conversions between frequency and velocity use the header's rest
+    frequency.
+    '''
+
+    axis = wavelength_array(header, number_of_channels)
+    ctype = header.get('CTYPE3', '').upper()
+
+    if unit == 'GHz' and ctype.startswith('FREQ'):
+        values, low, high = axis, low * 1e9, high * 1e9
+    elif unit == 'GHz':
+        rest = header.get('RESTFRQ', header.get('RESTFREQ'))
+        values = velocity_array(header, axis)
+        low, high = C_KMS * (1 - low * 1e9 / rest), C_KMS * (1 - high * 1e9 / rest)
+    elif unit == 'km/s':
+        values = velocity_array(header, axis)
+    else:
+        raise ValueError("unit must be 'GHz' or 'km/s', not {}".format(unit))
+
+    inside = np.flatnonzero((values >= min(low, high)) & (values <= max(low, high)))
+    if len(inside) == 0:
+        raise ValueError("No channels between {} and {} {}.".format(
+            min(low, high), max(low, high), unit))
+
+    return int(inside[0]), int(inside[-1]) + 1
+
+
+def grid_velocities(low, high, step):
+    '''A velocity grid from low to high (inclusive) in steps of step, in km/s'''
+
+    if step <= 0:
+        raise ValueError("The velocity grid's step must be positive, not {} km/s.".format(step))
+    if low > high:
+        raise ValueError("The velocity grid runs from {} to {} km/s; its low end must not be above its high end.".format(low, high))
+
+    return np.arange(low, high + step / 2.0, step)
+
+
+def grid_channels(velocity, grid):
+    '''The fractional channel of each velocity in grid, interpolated
+    along the cube's velocity axis (one velocity per channel, increasing
+    or decreasing)'''
+
+    channels = np.arange(len(velocity))
+    if velocity[-1] < velocity[0]:
+        velocity, channels = velocity[::-1], channels[::-1]
+
+    if np.min(grid) < velocity[0] or np.max(grid) > velocity[-1]:
+        raise ValueError("The velocity grid ({} to {} km/s) runs off the cube ({:.0f} to {:.0f} km/s).".format(
+            np.min(grid), np.max(grid), velocity[0], velocity[-1]))
+
+    return np.interp(grid, velocity, channels)
+
+
+def resample_channels(data, positions):
+    '''A cube (or Slab) linearly interpolated at fractional channel
+    positions, as one float32 (positions, y, x) array.
+
+    The channels either side of every position are read in one slice, and
+    all the frames are interpolated from it at once.
+    '''
+
+    low = np.minimum(np.floor(positions).astype(int), data.shape[0] - 2)
+    weight = (positions - low).astype(np.float32)[:, np.newaxis, np.newaxis]
+
+    start = low.min()
+    block = np.asarray(data[start:low.max() + 2], dtype=np.float32)
+
+    resampled = block[low - start]
+    resampled *= 1 - weight
+    resampled += block[low - start + 1] * weight
+
+    return resampled
+
+
+def gunzip_to_cache(cube, cache_dir):
+    '''Decompress a gzipped cube into cache_dir once, and reuse it after that.
+
+    The copy is named after the cube with a short hash of its full path, so
+    cubes with the same file name in different directories don't collide.
+    A small .json sidecar records the size and modification time of the
+    source, and the size of the decompressed copy. The copy is
+    reused only if the source hasn't changed and the copy is the size it was
+    written at; otherwise it is rebuilt. gzip itself checks the CRC and length
+    of the stream as it is decompressed, so a corrupt source raises rather
+    than leaving a bad copy behind.
+    '''
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    stat = os.stat(cube)
+    name = os.path.basename(cube)[:-len('.gz')]
+    root, extension = os.path.splitext(name)
+    digest = hashlib.sha1(os.path.abspath(cube).encode()).hexdigest()[:12]
+    cached = os.path.join(cache_dir, '{}_{}{}'.format(root, digest, extension))
+    sidecar = cached + '.json'
+
+    if os.path.isfile(cached) and os.path.isfile(sidecar):
+        with open(sidecar) as f:
+            record = json.load(f)
+        if (record['source'] == os.path.abspath(cube) and
+                record['source_size'] == stat.st_size and
+                record['source_mtime'] == stat.st_mtime and
+                record['size'] == os.path.getsize(cached)):
+            return cached
+        print("Cached copy of {} is stale, decompressing it again.".format(cube))
+
+    print("Decompressing {} to {}. Later runs will reuse it.".format(cube, cached))
+
+    size = 0
+    partial = cached + '.partial'
+
+    with gzip.open(cube, 'rb') as src, open(partial, 'wb') as dst:
+        while True:
+            block = src.read(16 * 1024 * 1024)
+            if not block:
+                break
+            size += len(block)
+            dst.write(block)
+
+    # Only move the copy into place once it's complete
+    os.replace(partial, cached)
+
+    with open(sidecar, 'w') as f:
+        json.dump({'source': os.path.abspath(cube),
+                   'source_size': stat.st_size,
+                   'source_mtime': stat.st_mtime,
+                   'size': size}, f, indent=2)
+
+    return cached
+
+
+def convert_cube(cube, store, chunks=DEFAULT_CHUNKS, compression='gzip', level=4):
+    '''Re-lay a FITS cube into a chunked, compressed HDF5 store.
+
+    The cube is copied one chunk-plane of channels at a time, so it never has
+    to fit in memory. The FITS header (including the spectral WCS) is kept
+    alongside the data so the store can be used anywhere a FITS path can.
+    A STAT extension, if there is one, is copied the same way. Floating
+    point data is stored as float32, which is all the movies use.
+    '''
+
+    import h5py
+
+    data, header = open_cube(cube)
+
+    try:
+        variance = open_variance(cube)
+    except (ValueError, KeyError):
+        variance = None
+
+    # Chunks can't be larger than the cube itself
+    chunks = tuple(min(c, s) for c, s in zip(chunks, data.shape))
+
+    if compression == 'none':
+        compression = None
+        level = None
+    elif compression != 'gzip':
+        # lzf takes no compression level
+        level = None
+
+    with h5py.File(store, 'w') as f:
+        for key, array in (('data', data), ('stat', variance)):
+            if array is None:
+                continue
+
+            dtype = np.float32 if array.dtype.kind == 'f' else array.dtype.newbyteorder('=')
+            dset = f.create_dataset(key, shape=array.shape, dtype=dtype,
+                                    chunks=chunks, compression=compression,
+                                    compression_opts=level,
+                                    shuffle=compression is not None)
+
+            for start in range(0, array.shape[0], chunks[0]):
+                stop = min(start + chunks[0], array.shape[0])
+                dset[start:stop] = array[start:stop]
+
+        f['data'].attrs['header'] = header.tostring()
+        f['data'].attrs['source'] = os.path.basename(cube)
+
+    return store
+
+
+# numpy dtypes of the FITS BITPIX values
+BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+
+def read_window(cube, start, stop):
+    '''Channels start:stop of a plain FITS cube, with one read of the file.
+
+    Copying out of a memory map faults the pages in while holding the GIL,
+    so nothing else in the process runs while it waits on the disk. A plain
+    read releases the GIL, so a reader thread can fetch the next cube
+    while the main thread renders. Returns None for anything but an
+    uncompressed, unscaled FITS cube; slice those as usual instead.
+    '''
+
+    if is_store(cube) or not cube.lower().endswith(('.fits', '.fit')):
+        return None
+
+    with fits.open(cube, memmap=True) as hdulist:
+        index = 0 if hdulist[0].header.get('NAXIS', 0) != 0 else 1
+        hdu = hdulist[index]
+        header = hdu.header
+        if (isinstance(hdu, fits.CompImageHDU) or header.get('BSCALE', 1) != 1 or
+                header.get('BZERO', 0) != 0 or header['NAXIS'] != 3):
+            return None
+        offset = hdulist.fileinfo(index)['datLoc']
+        dtype = np.dtype(BITPIX_DTYPES[header['BITPIX']])
+        ny, nx = header['NAXIS2'], header['NAXIS1']
+
+    window = np.empty((stop - start, ny, nx), dtype=dtype)
+
+    with open(cube, 'rb') as f:
+        f.seek(offset + start * ny * nx * dtype.itemsize)
+        if f.readinto(window.reshape(-1).view(np.uint8)) != window.nbytes:
+            return None
+
+    return window
+
+
+class Slab(object):
+    '''Channels of a cube, read into memory once.
+
+    Takes a list of (start, stop) channel windows, merges any that overlap
+    or touch, and reads each merged range with a single slice. It can then
+    be indexed like the cube itself (slab[channel], slab[start:stop, ...]),
+    as long as the channels asked for were read. If the cube's filename is
+    given, plain FITS cubes are read with read_window instead of slicing.
+
+    The channels are kept as native float32, whatever the cube stores, so
+    nothing downstream gets promoted to float64 or pays to byteswap FITS
+    data. With precision='uint16' they're kept quantized instead (see
+    QuantizedBlock), at half the memory, and come back as float32 when
+    sliced. limits, a list of (start, stop, low, high), quantizes those
+    channels between low and high only (see quantize; None for no limit).
+    Where limits overlap, the widest range wins, and channels outside them
+    all keep their whole range. Channels in the exact windows stay float32
+    anyway, if they don't merge with others: single channels, like
+    continuum channels, that every frame leans on.
+    '''
+
+    def __init__(self, data, windows, cube=None, precision='float32', limits=None, exact=None):
+
+        if precision not in ('float32', 'uint16'):
+            raise ValueError("precision must be 'float32' or 'uint16', not {}".format(precision))
+
+        self.shape = data.shape
+        self.dtype = np.dtype(np.float32)
+        self.precision = precision
+
+        self.blocks = []
+        for start, stop in merge_windows(windows, self.shape[0]):
+            block = read_window(cube, start, stop) if cube is not None else None
+            if block is not None and block.dtype == np.dtype('>f4') and not block.dtype.isnative:
+                # Swap the bytes of what was just read, rather than copying it
+                block = block.byteswap(inplace=True).view(block.dtype.newbyteorder())
+            if block is None:
+                block = data[start:stop]
+            block = np.asarray(block, dtype=np.float32)
+            if precision == 'uint16' and not any(exact_start <= start and stop <= exact_stop
+                                                 for exact_start, exact_stop in (exact or [])):
+                low, high = [], []
+                for channel in range(start, stop):
+                    covering = [limit[2:] for limit in (limits or []) if limit[0] <= channel < limit[1]]
+                    low.append(_widest([limit[0] for limit in covering], np.fmin))
+                    high.append(_widest([limit[1] for limit in covering], np.fmax))
+                block = QuantizedBlock(block, low=low, high=high)
+            self.blocks.append((start, stop, block))
+
+    @property
+    def nbytes(self):
+        return sum(block.nbytes for _, _, block in self.blocks)
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        channels, rest = key[0], key[1:]
+
+        if isinstance(channels, slice):
+            start, stop, step = channels.indices(self.shape[0])
+            last = stop - 1
+        else:
+            start = last = int(channels)
+            if start < 0:
+                start = last = start + self.shape[0]
+
+        for block_start, block_stop, block in self.blocks:
+            if block_start <= start and last < block_stop:
+                if isinstance(channels, slice):
+                    local = slice(start - block_start, stop - block_start, step)
+                else:
+                    local = start - block_start
+                return block[(local,) + rest]
+
+        raise KeyError("Channels {}-{} weren't read into this slab.".format(start, last))
+
+
+# The uint16 code that marks a NaN in a quantized block; values use the rest
+QUANTIZED_NAN = 65535
+
+
+def quantize(block, low=None, high=None):
+    '''Scale a float (channels, y, x) block into uint16, channel by channel.
+
+    Each channel's finite values are mapped linearly from its lowest to its
+    highest value onto codes 0-65534, and anything else (NaN, inf) to
+    QUANTIZED_NAN. Returns (codes, offset, step), per-channel float32
+    offsets and steps that dequantize turns the codes back with.
+
+    low and high, if given, have a limit for each channel: None, a number,
+    or a (y, x) image of them. Values below low are stored as NaN, and
+    values above high as high (or more), so only what's in between sets
+    the step.
+    Give them when nothing outside can be told apart anyway, like values
+    under a threshold or over a stretch's vmax, so a few spikes don't
+    coarsen everything.
+
+    Every finite value comes back within step / 2 of what it was (to
+    float32 rounding), where step is its channel's (highest - lowest) /
+    65534. That's 1/131068 of the channel's range, 128 times finer than the
+    256 colors a frame is drawn with, so a linear stretch over the
+    channel's range can only change where a pixel right on the edge
+    between two colors lands. The bound is absolute: on a log stretch,
+    pixels much fainter than the brightest one in their channel can lose
+    more, relative to themselves. In particular, an automatic log stretch
+    (no vmin) starts at the faintest positive pixel, which isn't kept, so
+    give a vmin or a threshold there. Blanked (NaN) pixels stay blank.
+    '''
+
+    block = np.asarray(block, dtype=np.float32)
+
+    codes = np.empty(block.shape, dtype=np.uint16)
+    offset = np.zeros(len(block), dtype=np.float32)
+    step = np.ones(len(block), dtype=np.float32)
+
+    # One channel at a time, so only a plane of float32 is made at once
+    for i, channel in enumerate(block):
+        floor = low[i] if low is not None else None
+        ceiling = high[i] if high is not None else None
+
+        kept = np.isfinite(channel)
+        if floor is not None:
+            with np.errstate(invalid='ignore'):
+                kept &= channel >= floor
+
+        scaled = channel.copy()
+        if ceiling is not None:
+            # Anything over high only needs to stay over it, so it's stored
+            # at high, or at the lowest value kept if that's more (high can
+            # be far below everything else where a per-pixel limit is)
+            with np.errstate(invalid='ignore'):
+                over = kept & (channel > ceiling)
+            under = kept & ~over
+            ceiling = np.broadcast_to(ceiling, channel.shape)[over]
+            if under.any():
+                ceiling = np.maximum(ceiling, scaled[under].min())
+            scaled[over] = ceiling
+        values = scaled[kept]
+
+        # A channel with nothing kept in it is all NaN codes
+        if len(values) == 0:
+            codes[i] = QUANTIZED_NAN
+            continue
+
+        # The same float32 offsets and steps encode the values and decode them
+        offset[i] = values.min()
+        step[i] = (np.float64(values.max()) - offset[i]) / (QUANTIZED_NAN - 1)
+        if step[i] == 0:
+            step[i] = 1
+
+        scaled -= offset[i]
+        scaled /= step[i]
+        np.rint(scaled, out=scaled)
+        np.clip(scaled, 0, QUANTIZED_NAN - 1, out=scaled)
+        scaled[~kept] = QUANTIZED_NAN
+        codes[i] = scaled
+
+    return codes, offset, step
+
+
+def dequantize(codes, offset, step):
+    '''Float32 values from quantized codes, with offset and step broadcast
+    against them'''
+
+    values = codes.astype(np.float32)
+    values *= step
+    values += offset
+    values[codes == QUANTIZED_NAN] = np.nan
+
+    return values
+
+
+class QuantizedBlock(object):
+    '''A float (channels, y, x) block kept as scaled uint16 codes (see
+    quantize), at half the size of float32, that gives back float32 when
+    it's sliced like an array. low and high are passed to quantize.'''
+
+    def __init__(self, block, low=None, high=None):
+
+        self.codes, self.offset, self.step = quantize(block, low=low, high=high)
+        self.shape = self.codes.shape
+        self.dtype = np.dtype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.offset.nbytes + self.step.nbytes
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        codes = self.codes[key]
+        offset = self.offset[key[0]]
+        step = self.step[key[0]]
+
+        # A range of channels: one offset and step along the first axis
+        if np.ndim(offset) > 0:
+            shape = (-1,) + (1,) * (codes.ndim - 1)
+            offset, step = offset.reshape(shape), step.reshape(shape)
+
+        return dequantize(codes, offset, step)
+
+
+def _widest(limits, pick):
+    '''The widest of some limits on a channel (with pick, np.fmin for low
+    ones and np.fmax for high ones), or None if any of them is None'''
+
+    if len(limits) == 0 or any(limit is None for limit in limits):
+        return None
+
+    widest = limits[0]
+    for limit in limits[1:]:
+        widest = pick(widest, limit)
+
+    return widest
+
+
+def merge_windows(windows, number_of_channels):
+    '''Clip (start, stop) channel windows to the cube and merge overlaps.
+    Channels before 0 are dropped, never wrapped around to the end.'''
+
+    clipped = []
+    for start, stop in windows:
+        start = max(int(start), 0)
+        stop = min(int(stop), number_of_channels)
+        if start < stop:
+            clipped.append((start, stop))
+
+    merged = []
+    for start, stop in sorted(clipped):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+
+    return merged
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import os
+import hashlib
+
+import numpy as np
+
+
+def cube_fingerprint(cube):
+    '''Identify a cube file by its path, size and modification time, so
+    anything made from it can be reused until the file changes'''
+
+    stat = os.stat(cube)
+
+    return hashlib.sha1(repr((os.path.abspath(cube), stat.st_size,
+                              stat.st_mtime)).encode()).hexdigest()
+
+
+class RenderCache(object):
+    '''Rendered frames on disk, content-addressed by how they were made.
+
+    Each frame is one .npy file named by the SHA-1 of its key: everything
+    that goes into the frame (the cube, the channel, the preprocessing, the
+    stretch, the colormap, the scale and the background). A frame with the
+    same key is the same frame, so changing the number of frames or moving
+    the center by a few channels only renders what's new.
+
+    The cache is kept under max_bytes by removing the least recently used
+    frames (by modification time, which a cache hit bumps) whenever a new
+    frame is added.
+    '''
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.hits = 0
+        self.misses = 0
+
+        # A running total, so the directory is only rescanned when it's full
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory)
+                        if entry.name.endswith('.npy'))
+
+    def path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest + '.npy')
+
+    def get(self, key):
+        '''The cached frame for this key, or None'''
+
+        path = self.path(key)
+        try:
+            frame = np.load(path)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        # Mark it as recently used
+        os.utime(path, None)
+        self.hits += 1
+
+        return frame
+
+    def put(self, key, frame):
+        '''Add a frame, then evict old ones if the cache is too big'''
+
+        path = self.path(key)
+        partial = path + '.partial'
+
+        # Only move the frame into place once it's complete
+        with open(partial, 'wb') as f:
+            np.save(f, frame)
+        os.replace(partial, path)
+
+        self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''Remove the least recently used frames until under max_bytes'''
+
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        self.size = total
+        if total <= self.max_bytes:
+            return
+
+        for mtime, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                # Someone else got to it first
+                pass
+            self.size -= size
+            if self.size <= self.max_bytes:
+                break
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+from matplotlib.colors import to_rgb
+
+from musemovie import Frame, upscale
+from overlay import Overlay
+
+
+class Gallery(object):
+    '''Many targets' movies tiled into one synchronized grid movie.
+
+    Each tile is one target, around its own (redshifted) line, and frame i
+    of the gallery is frame i of every movie. Make the movies on the same
+    velocity_grid so that frame is the same velocity in every tile; on the
+    cubes' own channels, tiles only share channel offsets, and a channel
+    spans a different velocity at each redshift. Movies are added one at a time and their frames are
+    copied straight into a shared (frames, height, width, 3) uint8 buffer,
+    so memory is bounded by the size of the gallery, however many cubes
+    go into it, and nothing is ever decoded from a GIF:
+
+        gallery = Gallery(len(targets))
+        for cube, name in targets:
+            gallery.add(MovieFrames(cube, ..., velocity_grid=grid), name)
+        write_gif(gallery, 'movies/gallery.gif')
+
+    Frames are shrunk or grown (nearest neighbour) to fit a tile x tile
+    square, and labelled with the target name.
+    '''
+
+    def __init__(self, number_of_targets, tile=200, columns=None, background_color='black', color='white'):
+
+        self.tile = int(tile)
+        self.columns = columns if columns is not None else int(np.ceil(np.sqrt(number_of_targets)))
+        self.rows = int(np.ceil(number_of_targets / float(self.columns)))
+        self.background = (np.array(to_rgb(background_color)) * 255).astype(np.uint8)
+        self.color = color
+
+        self.names = []
+        self.buffer = None
+
+    def __len__(self):
+        return 0 if self.buffer is None else len(self.buffer)
+
+    def __iter__(self):
+        # The channel is the frame's offset from the middle of the movie
+        for index in range(len(self)):
+            yield Frame(self.buffer[index], index - len(self) // 2, None, None)
+
+    def add(self, movie, name):
+        '''Render a movie's frames into the next tile'''
+
+        position = len(self.names)
+        if position >= self.rows * self.columns:
+            raise IndexError("The gallery only has room for {} targets.".format(
+                self.rows * self.columns))
+
+        # The first movie sets the number of frames
+        if self.buffer is None:
+            self.buffer = np.empty((len(movie), self.rows * self.tile,
+                                    self.columns * self.tile, 3), dtype=np.uint8)
+            self.buffer[:] = self.background
+
+        row, column = divmod(position, self.columns)
+        top = row * self.tile
+        left = column * self.tile
+
+        overlay = None
+        for index in range(min(len(movie), len(self.buffer))):
+            image = movie[index].image
+            scale = min(self.tile / float(image.shape[0]), self.tile / float(image.shape[1]))
+            image = upscale(image, scale)[:self.tile, :self.tile]
+
+            if overlay is None:
+                overlay = Overlay(image.shape, title=name, color=self.color)
+            image = overlay.composite(image)
+
+            y = top + (self.tile - image.shape[0]) // 2
+            x = left + (self.tile - image.shape[1]) // 2
+            self.buffer[index, y:y + image.shape[0], x:x + image.shape[1]] = image
+
+        self.names.append(name)
@@ -3,19 +3,12 @@ import glob
 
 import warnings
 
-from astropy.io import fits
-from astropy.wcs import WCS
-
 from astroquery.ned import Ned
 
-import numpy as np
-
 # import seaborn as sns
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
 from matplotlib import cm
 
-import imageio
+from musemovie import MovieFrames, write_gif, write_moment_maps
 
 # Some things we'll be doing throw runtimewarnings that we won't care about.
 warnings.filterwarnings('ignore')
@@ -23,6 +16,9 @@ warnings.filterwarnings('ignore')
 carsdata = '../data/MUSE/*/*binned.fits*'
 line_restwav = 6563  # Set the rest wavelength of the emission line you'd like
 scalefactor = 2.0  # Set the DPI scaling of the output image.
+moments = False  # If True, also save moment 0/1/2 maps (FITS with the celestial WCS, and PNG) next to each GIF
+find_line = False  # If True, center each movie on the line peak found in the cube, not just where the NED redshift puts it
+gzip_cache_dir = None  # e.g. '../data/MUSE_uncompressed/' to decompress .fits.gz cubes there once (keep it outside carsdata)
 
 cubes = []
 for cube in glob.glob(carsdata):
@@ -64,84 +60,22 @@ for name in target_names:
 def makeMovie(cube, name, redshift, center, numframes=30):
     '''Make the movie'''
 
-    ########### READ THE DATA CUBE ####################
-    hdulist = fits.open(cube)
-    data = hdulist[0].data
-    header = hdulist[0].header
-    wcs_3d = WCS(header)
-    wcs = wcs_3d.dropaxis(2)
-    hdulist.close()
-
-    number_of_channels = len(data[:, 0, 0])
-
-    # Create the wavelength array
-    wavelength = ((np.arange(number_of_channels) + 1.0) -
-                  header['CRPIX3']) * header['CD3_3'] + header['CRVAL3']
-
-    # This quick one liner finds the element in the wavelength array
-    # that is closest to the "target" wavelength, then returns that element's
-    # index.
-
-    # It finds the deviation between each array element and the target value,
-    # takes its absolute value, and then returns the index of
-    # the element with the smallest value in the resulting array.
-    # This is the number that is closest to the target.
-
-    center_channel = (np.abs(wavelength - center)).argmin()
-    #print("Emission line centroid for {} is in channel {}".format(name,center_channel))
-
-    movie_start = center_channel - numframes
-    movie_end = center_channel + numframes
-
-    slices_of_interest = np.arange(movie_start, movie_end, 1)
-
-    ########### CREATE AND SCRUB THE TEMPORARY FRAMESTORE ##############
-    temp_movie_dir = "framestore/"
-    if not os.path.exists(temp_movie_dir):
-        os.makedirs(temp_movie_dir)
-        print("Created a temporary directory called '{}', where movie frame .png files are stored. You can delete this afterward if you'd like.".format(temp_movie_dir))
-
-    png_files = []
+    # Always perform a dumb continuum subtraction, blanking anything fainter
+    # than 0.005. Gzipped cubes are decompressed into the cache once, then
+    # memory-mapped.
+    movie = MovieFrames(cube, center, frames=numframes,
+                        scalefactor=scalefactor, contsub=True,
+                        contsub_floor=0.005, cmap=cm.magma,
+                        background_color='black', linear=False,
+                        cache_dir=gzip_cache_dir, find_line=find_line)
 
-    # Clean the temporary movie directory first
-    # If you don't remove all "old" movie frames, your gif is gonna be messed up.
-    for f in glob.glob(temp_movie_dir + "*.png"):
-        os.remove(f)
-    #####################################################################
+    if find_line is True:
+        redshift = movie.center / line_restwav - 1
+        print("Found the line for {} at {} Angstroms (expected {}), which implies z={}".format(
+            name, round(movie.center, 2), round(center, 2), round(redshift, 5)))
 
     print("Making movie for {} at z={}. Line centroid is in channel {}.".format(
-        name, round(redshift, 3), center_channel))
-
-    for i, slice in enumerate(slices_of_interest):
-        # Perform a dumb continuum subtraction. Risky if you land on another line.
-        cont_sub_image = data[slice, :, :] - data[center_channel - 200, :, :]
-        cont_sub_image[cont_sub_image < 0.005] = np.nan
-
-        sizes = np.shape(cont_sub_image)
-        height = float(sizes[0]) * scalefactor
-        width = float(sizes[1]) * scalefactor
-
-        fig = plt.figure()
-        fig.set_size_inches(width / height, 1, forward=False)
-        ax = plt.Axes(fig, [0., 0., 1., 1.])
-        ax.set_axis_off()
-        fig.add_axes(ax)
-
-        #cmap = sns.cubehelix_palette(20, light=0.95, dark=0.15, as_cmap=True)
-        cmap = cm.magma
-        cmap.set_bad('black', 1)
-
-        ax.imshow(cont_sub_image, origin='lower', norm=LogNorm(),
-                  cmap=cmap, interpolation='None')
-
-        fig.subplots_adjust(bottom=0)
-        fig.subplots_adjust(top=1)
-        fig.subplots_adjust(right=1)
-        fig.subplots_adjust(left=0)
-
-        fig.savefig(temp_movie_dir + '{}'.format(i) + '.png', dpi=height)
-        png_files.append(temp_movie_dir + '{}'.format(i) + '.png')
-        plt.close(fig)
+        name, round(redshift, 3), movie.center_channel))
 
     ########### CREATE AND SCRUB THE GIF DIRECTORY ##############
     gif_output_dir = "movies/"
@@ -151,18 +85,13 @@ def makeMovie(cube, name, redshift, center, numframes=30):
     #############################################################
 
     gif_name = gif_output_dir + '{}.gif'.format(name)
-    gif_frames = []
-
-    # Remove any old GIFs you might have made
-    if os.path.isfile(gif_name):
-        os.remove(gif_name)
 
-    for filename in png_files:
-        gif_frames.append(imageio.imread(filename))
-
-    imageio.mimsave(gif_name, gif_frames)
+    write_gif(movie, gif_name)
     print("Done. Saved to {}.".format(gif_name))
 
+    if moments is True:
+        write_moment_maps(movie, gif_output_dir + name, cmap=cm.magma)
+
 
 for index, cube in enumerate(cubes):
     makeMovie(cube, target_names[index], redshifts[index],
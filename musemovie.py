@@ -1,160 +1,1557 @@
 #!/usr/bin/env python
 
 import os
-import glob
+import sys
+import hashlib
+
+from collections import namedtuple
 
 import argparse
 
 import warnings
 
+from concurrent.futures import ThreadPoolExecutor
+
 from astropy.io import fits
 from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
 
 import numpy as np
 
 from tqdm import tqdm as progressbar
 
 import seaborn as sns
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import LogNorm, Normalize, to_rgb
+from matplotlib.image import imsave
 from matplotlib import cm
 
 import imageio
 
+from cubeio import open_cube, open_variance, convert_cube, read_header, wavelength_array, velocity_array, grid_velocities, grid_channels, resample_channels, Slab, DEFAULT_CHUNKS, C_KMS, CONTINUUM_OFFSET
+from binning import quadtree_bins, voronoi_bins
+from framecache import RenderCache, cube_fingerprint
+from overlay import Overlay, nice_scalebar
+from quicklook import contact_sheet
+from catalog import RedshiftCatalog, construct_filename_dictionaries, load_aliases, DEFAULT_ALIASES
+
 # Some things we'll be doing throw runtimewarnings that we won't care about.
 warnings.filterwarnings('ignore')
 
 
-def makeMovie(cube, redshift, center, name, thresh=None, frames=30, scalefactor=3.0, vmin=None, vmax=None, contsub=False, whitebg=False, linear=False):
-    '''Make the movie'''
+# Rest (air) wavelengths, in Angstroms, of lines you can ask for by name
+LINES = {'Hbeta': 4861.33,
+         'OIII4959': 4958.91,
+         'OIII5007': 5006.84,
+         'NII6548': 6548.05,
+         'Halpha': 6562.80,
+         'NII6583': 6583.45,
+         'SII6716': 6716.44,
+         'SII6731': 6730.82}
 
-    # Read the data cube
-    hdulist = fits.open(cube)
+# ...and sets of them
+LINE_SETS = {'NII-Halpha-SII': ['NII6548', 'Halpha', 'NII6583', 'SII6716', 'SII6731'],
+             'Hbeta-OIII': ['Hbeta', 'OIII4959', 'OIII5007'],
+             'all': sorted(LINES, key=LINES.get)}
 
-    data = hdulist[0].data
-    header = hdulist[0].header
+# What you get back for each frame of a MovieFrames sequence
+Frame = namedtuple('Frame', ['image', 'channel', 'wavelength', 'velocity'])
 
-    # Most pipeline cubes will have data in 1st extension.
-    if data is None:
-        data = hdulist[1].data
-        header = hdulist[1].header
 
-    hdulist.close()
+def parse_lines(restwavs):
+    '''Turn rest wavelengths, line names and line set names into {label: restwav}'''
 
-    number_of_channels = len(data[:, 0, 0])
+    lines = {}
+    for restwav in restwavs:
+        if restwav in LINE_SETS:
+            for line in LINE_SETS[restwav]:
+                lines[line] = LINES[line]
+        elif restwav in LINES:
+            lines[restwav] = LINES[restwav]
+        else:
+            try:
+                lines[restwav] = float(restwav)
+            except ValueError:
+                raise ValueError("{} isn't a wavelength, or one of these lines or line sets: {}".format(
+                    restwav, ', '.join(list(LINES) + list(LINE_SETS))))
 
-    # Create the wavelength array
-    wavelength = ((np.arange(number_of_channels) + 1.0) -
-                  header['CRPIX3']) * header['CD3_3'] + header['CRVAL3']
+    return lines
 
-    # This quick one liner finds the element in the wavelength array
-    # that is closest to the "target" wavelength, then returns that element's
-    # index.
 
-    # It finds the deviation between each array element and the target value,
-    # takes its absolute value, and then returns the index of
-    # the element with the smallest value in the resulting array.
-    # This is the number that is closest to the target.
+def check_wavelength(center, wavelength, what):
+    '''Raise a ValueError saying what it's for if center is off the cube'''
 
-    center_channel = (np.abs(wavelength - center)).argmin()
-    #print("Emission line centroid for {} is in channel {}".format(name,center_channel))
+    if not min(wavelength[0], wavelength[-1]) <= center <= max(wavelength[0], wavelength[-1]):
+        raise ValueError("{} is off the cube, which covers {} to {} Angstroms.".format(
+            what, round(float(min(wavelength[0], wavelength[-1])), 1),
+            round(float(max(wavelength[0], wavelength[-1])), 1)))
 
-    movie_start = center_channel - frames
-    movie_end = center_channel + frames
 
-    slices_of_interest = np.arange(movie_start, movie_end, 1)
+def check_window(start, stop, number_of_channels, what, contsub_channel=None):
+    '''Raise a ValueError saying what it's for if a movie needs channels
+    (start to stop, and its continuum channel) that aren't in the cube'''
 
-    # Create and scrub the temporary framestore directory
-    temp_movie_dir = "framestore/"
-    if not os.path.exists(temp_movie_dir):
-        os.makedirs(temp_movie_dir)
-        print("Created a temporary directory called '{}', where movie frame .png files are stored. You can delete this afterward if you'd like.".format(temp_movie_dir))
+    if start < 0 or stop > number_of_channels:
+        raise ValueError("{} needs channels {} to {}, but the cube only has channels 0 to {}.".format(
+            what, start, stop - 1, number_of_channels - 1))
+    if contsub_channel is not None and contsub_channel < 0:
+        raise ValueError("{} needs channel {} for the continuum subtraction, which is off the cube.".format(
+            what, contsub_channel))
 
-    png_files = []
 
-    # Clean the temporary movie directory first
-    # If you don't remove all "old" movie frames, the gif will be messed up.
-    for f in glob.glob(temp_movie_dir + "*.png"):
-        os.remove(f)
+def find_line_center(data, wavelength, center, search_width=50.0, region='core', stride=2):
+    '''Find the emission line peak near where we expect it, from the data.
 
-    print("Making movie for {} at z={}. Line centroid is in channel {}".format(
-        name, round(redshift, 3), center_channel))
+    Reads every channel within search_width Angstroms of center, but only
+    every stride-th pixel, in one go. Each pixel's median over the window is
+    taken as its continuum and subtracted, and the result is collapsed into
+    a spectrum, either over the whole field or over its bright core (the top
+    5% of pixels in line flux). Returns the wavelength of the spectrum's
+    peak, refined to sub-channel precision with a parabola.
+    '''
+
+    window = np.flatnonzero(np.abs(wavelength - center) <= search_width)
+    if len(window) < 3:
+        raise ValueError("The {} +/- {} Angstrom search window is outside the cube.".format(
+            center, search_width))
+
+    start = window[0]
+    stop = window[-1] + 1
+
+    slab = np.asarray(data[start:stop, ::stride, ::stride], dtype=np.float32)
+    slab = slab.reshape(len(slab), -1)
+
+    # The line only fills a few channels of the window, so the median of each
+    # pixel over the window is a decent continuum.
+    line = slab - np.nanmedian(slab, axis=0)
+
+    if region == 'core':
+        flux = np.nansum(line, axis=0)
+        core = flux >= np.nanpercentile(flux, 95)
+        spectrum = np.nansum(line[:, core], axis=1)
+    elif region == 'field':
+        spectrum = np.nansum(line, axis=1)
+    else:
+        raise ValueError("region must be 'core' or 'field', not {}".format(region))
+
+    peak = int(np.argmax(spectrum))
+
+    offset = 0.0
+    if 0 < peak < len(spectrum) - 1:
+        left, middle, right = spectrum[peak - 1:peak + 2]
+        curvature = left - 2.0 * middle + right
+        if curvature < 0:
+            offset = 0.5 * (left - right) / curvature
+
+    step = wavelength[1] - wavelength[0]
+
+    return wavelength[start + peak] + offset * step
+
+
+class MovieFrames(object):
+    '''A lazy sequence of rendered movie frames.
+
+    Each item is a Frame of (image, channel, wavelength, velocity), where
+    image is an RGB uint8 array and velocity is the offset in km/s from the
+    line center. Frames are only rendered when they're first asked for, and
+    kept after that, so indexing or iterating again is free:
+
+        movie = MovieFrames('cube.fits', 6563.0 * (1 + 0.0035), frames=25)
+        len(movie)                   # 50
+        movie[25].velocity           # ~0 km/s
+        for frame in movie: ...      # renders as it goes
+
+    For a radio cube, give a channel window (see cubeio.channel_window)
+    and center=None. find_line=True centers the movie on the line peak near
+    center; velocity_grid=(low, high, step) puts the frames on a fixed grid
+    in km/s. A movie that would run off the cube raises a ValueError.
+    render_cache reuses frames rendered before with the same settings, and
+    precision='uint16' holds the channels quantized (see cubeio.quantize).
+    To make movies of several lines from one read, use line_movies.
+    '''
+
+    render_cache = None
+    fingerprint = None
+    cache_hits = 0
+
+    def __init__(self, cube, center, frames=30, thresh=None, scalefactor=3.0, vmin=None, vmax=None, contsub=False, contsub_floor=None, cmap=cm.plasma, background_color='black', linear=False, cache_dir=None, find_line=False, search_width=50.0, search_region='core', snr=None, snr_smooth=None, variance=None, binning=None, target_snr=10.0, interp=0, render_cache=None, fingerprint=None, window=None, velocity_grid=None, precision='float32'):
+
+        # Read the data cube. This can be a FITS file (plain, gzipped or
+        # tile-compressed) or a converted store; either way, channels are
+        # only read from disk when they're sliced. It can also be a
+        # (data, header) pair that's already open, like a shared Slab.
+        if isinstance(cube, tuple):
+            self.data, self.header = cube
+            self.source = None
+        else:
+            self.data, self.header = open_cube(cube, cache_dir=cache_dir)
+            self.source = cube
+
+        # The variance (STAT) is only needed for S/N thresholding and
+        # binning. It gets sliced channel by channel just like the data.
+        self.snr = snr
+        self.snr_smooth = snr_smooth
+        self.variance = variance
+        if snr is not None and variance is None:
+            self.variance = open_variance(cube, cache_dir=cache_dir)
+        elif binning is not None and variance is None and not isinstance(cube, tuple):
+            try:
+                self.variance = open_variance(cube, cache_dir=cache_dir)
+            except (ValueError, KeyError):
+                # Binning can estimate the noise from the data instead
+                self.variance = None
+
+        number_of_channels = self.data.shape[0]
+
+        wavelength = wavelength_array(self.header, number_of_channels)
+
+        # This quick one liner finds the element in the wavelength array
+        # that is closest to the "target" wavelength, then returns that
+        # element's index.
+
+        # It finds the deviation between each array element and the target
+        # value, takes its absolute value, and then returns the index of
+        # the element with the smallest value in the resulting array.
+        # This is the number that is closest to the target.
+
+        if window is not None:
+            # An explicit range of channels, rather than frames either side
+            # of a line. Radio cubes measure velocities from their rest
+            # frequency (or have a velocity axis); anything else from the
+            # middle of the window.
+            movie_start = max(int(window[0]), 0)
+            movie_end = min(int(window[1]), number_of_channels)
+            self.center_channel = (movie_start + movie_end) // 2
+            if center is None and 'RESTFRQ' not in self.header and 'RESTFREQ' not in self.header and \
+                    not self.header.get('CTYPE3', '').upper().startswith(('VRAD', 'VELO', 'VOPT')):
+                center = wavelength[self.center_channel]
+        else:
+            if find_line is True:
+                center = find_line_center(self.data, wavelength, center,
+                                          search_width=search_width,
+                                          region=search_region)
+            check_wavelength(center, wavelength, "The movie around {} Angstroms".format(
+                round(float(center), 1)))
+
+            self.center_channel = int((np.abs(wavelength - center)).argmin())
+
+            movie_start = self.center_channel - frames
+            movie_end = self.center_channel + frames
+
+        self.center = center
+
+        velocity = velocity_array(self.header, wavelength, center)
+
+        # On a velocity grid, frames sit wherever the grid puts them, and
+        # the movie needs the channels either side of each
+        self.velocity_grid = velocity_grid
+        if velocity_grid is not None:
+            if interp > 0:
+                raise ValueError("A movie can be on a velocity grid or interpolated, not both.")
+            grid = grid_velocities(*velocity_grid)
+            positions = grid_channels(velocity, grid)
+            movie_start = int(np.floor(positions.min()))
+            movie_end = min(int(np.floor(positions.max())) + 2, number_of_channels)
+
+        # Rather than silently wrapping around or running off the end
+        if window is None:
+            what = "The movie around {} Angstroms".format(round(float(center), 1))
+        else:
+            what = "The movie of channels {} to {}".format(movie_start, movie_end - 1)
+        check_window(movie_start, movie_end, number_of_channels, what,
+                     self.center_channel - CONTINUUM_OFFSET if contsub is True else None)
+
+        self.source_channels = np.arange(movie_start, movie_end, 1)
+        self.source_velocities = velocity[self.source_channels]
+
+        # With interp, there are interp frames between each pair of channels,
+        # interpolated from the two, so frame channels can be fractional.
+        self.interp = interp
+        if velocity_grid is not None:
+            self.channels = positions
+        elif interp > 0:
+            steps = (len(self.source_channels) - 1) * (interp + 1) + 1
+            self.channels = movie_start + np.arange(steps) / float(interp + 1)
+        else:
+            self.channels = self.source_channels
+
+        self.wavelengths = np.interp(self.channels, np.arange(number_of_channels),
+                                     wavelength)
+        self.velocities = np.interp(self.channels, np.arange(number_of_channels),
+                                    velocity)
+        if velocity_grid is not None:
+            self.velocities = grid
+
+        self.thresh = thresh
+        self.scalefactor = scalefactor
+        self.contsub = contsub
+        self.contsub_floor = contsub_floor
+        self.linear = linear
+        self.vmin = vmin
+        self.vmax = vmax
+
+        # Set the background color (usually black or white, depending on
+        # the cmap) on a copy, so the registered colormap isn't changed.
+        self.cmap = cmap.with_extremes(bad=background_color)
+
+        self.binning = None
+        self.binning_options = None
+        if binning is not None:
+            self.binning_options = (binning, target_snr)
+
+        # Interpolated frames revisit every channel interp + 1 times, so read
+        # them all into memory once. Quantized frames all come from memory.
+        self.precision = precision
+        if interp > 0 or precision != 'float32':
+            self.load()
+
+        # The tessellation is built once, and applied to every frame
+        if binning is not None:
+            self.binning = self.build_binning(binning, target_snr)
+            print("Binned the field into {} {} bins toward S/N={}.".format(
+                self.binning.nbins, binning, target_snr))
+
+        # Frames are cached by what went into them, down to the colors
+        if render_cache is not None:
+            if fingerprint is None and not isinstance(cube, tuple):
+                fingerprint = cube_fingerprint(cube)
+            self.render_cache = render_cache
+            self.fingerprint = fingerprint
+            self._cmap_key = hashlib.sha1(self.cmap(np.linspace(0, 1, 256)).tobytes() +
+                                          np.array(self.cmap.get_bad()).tobytes()).hexdigest()
+
+        self.overlay_options = None
+        self._rendered = {}
+        self._buffers = {}
+        self._canvas = None
+        self._resampled = None
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        return self.frame(index)
+
+    def frame(self, index, keep=True):
+        '''Frame index, rendered if it hasn't been already. With keep=False
+        a newly rendered frame isn't held on to, for callers that keep their
+        own copy.'''
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("frame index out of range")
+
+        if index in self._rendered:
+            return Frame(self._rendered[index], *self.metadata(index))
+
+        rendered = None
+        cached = self.render_cache is not None and self.fingerprint is not None
+        if cached:
+            rendered = self.render_cache.get(self.frame_key(index))
+            if rendered is not None:
+                self.cache_hits += 1
+        if rendered is None:
+            rendered = self.render(self.image(index))
+            if cached:
+                self.render_cache.put(self.frame_key(index), rendered)
+        if self.overlay_options is not None:
+            rendered = self.get_overlay(rendered.shape).composite(
+                rendered, self.label(index))
+        if keep is True:
+            self._rendered[index] = rendered
+
+        return Frame(rendered, *self.metadata(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def add_overlay(self, title=None, label='velocity', scalebar='auto', colorbar=False, color='white'):
+        '''Draw a title, a per-frame label, a scale bar and a colorbar on
+        every frame.
+
+        label is 'velocity', 'wavelength' or None. scalebar is a length in
+        arcsec, 'auto' for a round number about a fifth of the field, or
+        None. The colorbar needs fixed vmin and vmax. Frames already
+        rendered are rendered again with the overlay.
+        '''
+
+        self.overlay_options = dict(title=title, label=label,
+                                    scalebar=scalebar, colorbar=colorbar,
+                                    color=color)
+        self._overlay = None
+        self._rendered = {}
+
+    def get_overlay(self, shape):
+        '''The Overlay for frames of this shape, built the first time it's needed'''
+
+        if self._overlay is None:
+            options = self.overlay_options
+
+            pixscale = None
+            scalebar = options['scalebar']
+            if scalebar is not None:
+                # Arcsec per cube pixel, then per frame pixel
+                pixscale = proj_plane_pixel_scales(
+                    WCS(self.header).celestial).mean() * 3600
+                field = pixscale * self.header['NAXIS1']
+                pixscale *= self.header['NAXIS1'] / float(shape[1])
+                if scalebar == 'auto':
+                    scalebar = nice_scalebar(field)
+
+            cmap = limits = None
+            if options['colorbar'] is True:
+                if getattr(self, 'vmin', None) is None or getattr(self, 'vmax', None) is None:
+                    print("A colorbar needs --vmin and --vmax, so every frame has the same one. Skipping it.")
+                else:
+                    cmap = self.cmap
+                    limits = (self.vmin, self.vmax)
+
+            self._overlay = Overlay(shape, title=options['title'],
+                                    scalebar=scalebar, pixscale=pixscale,
+                                    cmap=cmap, limits=limits,
+                                    color=options['color'])
+
+        return self._overlay
+
+    def label(self, index):
+        '''The per-frame overlay label'''
+
+        if self.overlay_options['label'] == 'velocity':
+            return '{:+.0f} km/s'.format(self.velocities[index])
+        elif self.overlay_options['label'] == 'wavelength':
+            # For composites, the green line's
+            wavelengths = np.atleast_1d(self.wavelengths[index])
+            return '{:.1f} A'.format(wavelengths[len(wavelengths) // 2])
+
+        return None
+
+    def frame_key(self, index):
+        '''Everything that goes into rendering one frame (before overlays)'''
+
+        window = None
+        if self.binning is not None:
+            # The bins depend on which channels are summed to make them
+            window = (int(self.source_channels[0]), int(self.source_channels[-1]))
+
+        return (self.fingerprint, float(self.channels[index]),
+                self.contsub, self.center_channel if self.contsub is True else None,
+                self.contsub_floor, self.thresh, self.snr, self.snr_smooth,
+                self.binning_options, window, self.linear, self.vmin, self.vmax,
+                self._cmap_key, self.scalefactor, self.precision)
+
+    def metadata(self, index):
+        '''(channel, wavelength, velocity) of one frame'''
+
+        # Interpolated frames sit between channels
+        if self.interp > 0 or self.velocity_grid is not None:
+            channel = float(self.channels[index])
+        else:
+            channel = int(self.channels[index])
+
+        return (channel, float(self.wavelengths[index]),
+                float(self.velocities[index]))
+
+    def image(self, index, out=None):
+        '''The (continuum subtracted, thresholded) image for one frame.
+
+        This is written into out, a float32 image, or by default into a
+        buffer that's reused for every frame, so copy it to keep it. The
+        cube itself is never changed.
+        '''
+
+        if out is None:
+            out = self.buffer('image', np.float32)
+
+        position = self.channels[index]
+        low = int(np.floor(position))
+        weight = position - low
+
+        if weight == 0:
+            return self.preprocess(self.data[low, :, :], low, out=out)
+
+        # Frames on a velocity grid are all resampled at once
+        if self.velocity_grid is not None:
+            if self._resampled is None:
+                self.load()
+                self._resampled = resample_channels(self.data, self.channels)
+            return self.preprocess(self._resampled[index], (low, weight), out=out)
+
+        # An interpolated frame, between the channels either side of it
+        following = self.buffer('following', np.float32)
+        np.multiply(self.data[low, :, :], 1 - weight, out=out)
+        np.multiply(self.data[low + 1, :, :], weight, out=following)
+        out += following
+
+        return self.preprocess(out, (low, weight), out=out)
+
+    def buffer(self, name, dtype, shape=None):
+        '''A scratch array of one frame's shape (or shape), made the first
+        time it's asked for and reused after that'''
+
+        if shape is None:
+            shape = self.data.shape[1:]
+
+        array = self._buffers.get(name)
+        if array is None or array.shape != tuple(shape):
+            array = np.empty(shape, dtype=dtype)
+            self._buffers[name] = array
+
+        return array
+
+    def load(self):
+        '''Read every channel the frames need into memory in one go, so that
+        frames, slabs, moment maps and channel maps never go back to disk'''
+
+        if isinstance(self.data, Slab):
+            return
+
+        windows = [(self.source_channels[0], self.source_channels[-1] + 1)]
+        if self.contsub is True:
+            windows.append((self.center_channel - CONTINUUM_OFFSET, self.center_channel - CONTINUUM_OFFSET + 1))
+
+        # Only frames drawn straight from one channel quantize over just
+        # what they can show (see quantize_limits); the continuum stays exact
+        limits = None
+        if self.precision == 'uint16' and self.binning_options is None and self.snr is None and \
+                self.interp == 0 and self.velocity_grid is None:
+            continuum = None
+            if self.contsub is True:
+                continuum = self.data[self.center_channel - CONTINUUM_OFFSET, :, :]
+            low, high = quantize_limits(self.thresh, self.vmax, self.contsub_floor, continuum,
+                                        linear=self.linear)
+            limits = [windows[0] + (low, high)]
+
+        self.data = Slab(self.data, windows, cube=self.source, precision=self.precision,
+                         limits=limits, exact=windows[1:])
+        if self.variance is not None and not isinstance(self.variance, Slab):
+            self.variance = Slab(self.variance, windows)
+
+    def slab(self):
+        '''The (continuum subtracted, thresholded) images for every frame,
+        as one (frames, y, x) array'''
+
+        channels = slice(self.source_channels[0], self.source_channels[-1] + 1)
+
+        return self.preprocess(np.asarray(self.data[channels, :, :]), channels)
+
+    def preprocess(self, images, channels, out=None):
+        '''Continuum subtract, bin and threshold one image, or a stack of them.
+
+        The result is float32, written into out if it's given (out can be
+        images itself) or a new array if not; images is never changed.
+        '''
+
+        if out is None:
+            out = np.empty(np.shape(images), dtype=np.float32)
 
-    for i, slice in enumerate(progressbar(slices_of_interest)):
         # Perform a dumb continuum subtraction.
         # Risky if you land on another line.
+        if self.contsub is True:
+            np.subtract(images, self.data[self.center_channel - CONTINUUM_OFFSET, :, :], out=out)
+        else:
+            np.copyto(out, images)
+
+        if self.binning is not None:
+            out[...] = self.binning.apply(out)
+
+        # The S/N is measured before any masking, so the smoothing isn't
+        # thrown off by NaNs from the thresholds.
+        if self.snr is not None:
+            snr = self.snr_map(out, channels)
+
+        # Both thresholds blank what's below them, so only the higher one
+        # needs checking
+        cuts = [self.thresh]
+        if self.contsub is True:
+            cuts.append(self.contsub_floor)
+        cuts = [cut for cut in cuts if cut is not None]
+
+        if len(cuts) > 0 or self.snr is not None:
+            if out.ndim == 2:
+                blank = self.buffer('blank', bool)
+            else:
+                blank = np.empty(out.shape, dtype=bool)
+
+            if len(cuts) > 0:
+                with np.errstate(invalid='ignore'):
+                    np.less(out, max(cuts), out=blank)
+                np.copyto(out, np.nan, where=blank)
+
+            if self.snr is not None:
+                with np.errstate(invalid='ignore'):
+                    np.greater_equal(snr, self.snr, out=blank)
+                np.logical_not(blank, out=blank)
+                np.copyto(out, np.nan, where=blank)
+
+        return out
+
+    def snr_map(self, images, channels):
+        '''Signal-to-noise of one (continuum subtracted, binned) image or a
+        stack of them, from the STAT variance.
+
+        With snr_smooth, S/N is measured in a snr_smooth x snr_smooth pixel
+        box around each pixel (summed signal over the root of the summed
+        variance) so faint extended emission can beat the noise.
+        '''
+
+        if isinstance(channels, tuple):
+            # An interpolated frame: (low channel, weight of the next one)
+            low, weight = channels
+            variance = ((1 - weight) ** 2 * self.variance[low] +
+                        weight ** 2 * self.variance[low + 1]).astype(np.float32)
+        else:
+            variance = np.array(self.variance[channels], dtype=np.float32)
+
+        if self.contsub is True:
+            variance += self.variance[self.center_channel - CONTINUUM_OFFSET]
+
+        if self.binning is not None:
+            variance = self.binning.apply_variance(variance)
+
+        signal = np.asarray(images, dtype=np.float32)
+
+        if self.snr_smooth is not None and self.snr_smooth > 1:
+            from scipy.ndimage import uniform_filter
+
+            # Blank pixels add nothing to the box
+            signal = np.nan_to_num(signal, nan=0.0)
+            variance = np.nan_to_num(variance, nan=0.0)
+
+            # Smooth spatially only, never across channels. The box means
+            # are the sums over n x n pixels divided by n^2, so
+            # S/N = sum / sqrt(summed variance) = n * mean / sqrt(variance mean)
+            size = (1,) * (signal.ndim - 2) + (self.snr_smooth, self.snr_smooth)
+            signal = uniform_filter(signal, size=size, mode='constant')
+            variance = uniform_filter(variance, size=size, mode='constant')
+            signal *= self.snr_smooth
+
+        # Anything without a usable variance comes out NaN, and gets masked
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return signal / np.sqrt(variance)
+
+    def build_binning(self, method, target_snr):
+        '''Bin the field toward target_snr, from the S/N of the line summed
+        over every frame.
+
+        The noise comes from the STAT variance if the cube has one, and
+        otherwise from each pixel's channel-to-channel scatter.
+        '''
+
+        channels = slice(self.source_channels[0], self.source_channels[-1] + 1)
+
+        images = np.array(self.data[channels, :, :], dtype=np.float32)
+        if self.contsub is True:
+            images -= self.data[self.center_channel - CONTINUUM_OFFSET, :, :]
+
+        signal = np.nansum(images, axis=0)
+
+        if self.variance is not None:
+            variance = np.nansum(np.asarray(self.variance[channels], dtype=np.float32), axis=0)
+            if self.contsub is True:
+                variance += len(images) * self.variance[self.center_channel - CONTINUUM_OFFSET]
+        else:
+            # The line only fills a few channels, so a robust scatter along
+            # the spectrum is mostly noise
+            deviation = np.abs(images - np.nanmedian(images, axis=0))
+            sigma = 1.4826 * np.nanmedian(deviation, axis=0)
+            variance = len(images) * sigma ** 2
+
+        if method == 'quadtree':
+            return quadtree_bins(signal, variance, target_snr)
+        elif method == 'voronoi':
+            return voronoi_bins(signal, variance, target_snr)
+        else:
+            raise ValueError("binning must be 'quadtree' or 'voronoi', not {}".format(method))
+
+    def moment_maps(self):
+        '''Moment 0 (flux), 1 (velocity) and 2 (dispersion) maps of the line.
+
+        These come from the same continuum subtracted, thresholded channels
+        as the frames, reduced along the spectral axis in one go. Moment 0
+        is in the cube's flux units times km/s; moments 1 and 2 are in km/s
+        relative to the line center.
+        '''
+
+        # The products stay float32; only the sums along the spectral axis
+        # are done in float64
+        flux = np.nan_to_num(self.slab(), nan=0.0)
+        velocities = self.source_velocities.astype(np.float32)[:, np.newaxis, np.newaxis]
+        step = np.abs(self.source_velocities[1] - self.source_velocities[0])
+
+        total = flux.sum(axis=0, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            moment1 = (flux * velocities).sum(axis=0, dtype=np.float64) / total
+            moment2 = np.sqrt(np.maximum(
+                (flux * (velocities - moment1.astype(np.float32)) ** 2).sum(
+                    axis=0, dtype=np.float64) / total, 0))
+
+        blank = total <= 0
+        moment0 = total * step
+        for moment in (moment0, moment1, moment2):
+            moment[blank] = np.nan
+
+        return moment0, moment1, moment2
+
+    def channel_map(self, step=2, columns=None):
+        '''A grid of every step-th channel of the movie, as one RGB image.
+
+        The panels all come from one preprocessed slab and share one stretch
+        (vmin and vmax, or the range of the panels where those aren't set),
+        so the whole grid goes through the colormap at once rather than a
+        figure per panel. Panels run left to right, top to bottom, from the
+        blue side of the line to the red, each labelled with its velocity.
+        '''
+
+        panels = self.slab()[::step]
+        velocities = self.source_velocities[::step]
+
+        if self.linear is True:
+            finite = panels[np.isfinite(panels)]
+            norm = Normalize
+        else:
+            finite = panels[np.isfinite(panels) & (panels > 0)]
+            norm = LogNorm
+
+        vmin = self.vmin if self.vmin is not None else (finite.min() if len(finite) > 0 else 1.0)
+        vmax = self.vmax if self.vmax is not None else (finite.max() if len(finite) > 0 else 10.0)
+
+        # (Log norms only take flat or 2D arrays)
+        scaled = norm(vmin=vmin, vmax=vmax)(np.ma.masked_invalid(panels.ravel()))
+        rgb = self.cmap(scaled, bytes=True)[:, :3].reshape(panels.shape + (3,))
+
+        # Flip so row 0 is at the bottom, like imshow(origin='lower'), and
+        # scale every panel up at once
+        rgb = upscale(rgb[:, ::-1].transpose(1, 2, 0, 3), self.scalefactor)
+        rgb = np.ascontiguousarray(rgb.transpose(2, 0, 1, 3))
+
+        color = 'black' if np.mean(self.cmap.get_bad()[:3]) > 0.5 else 'white'
+        rgb = Overlay(rgb.shape[1:3], color=color).composite(
+            rgb, ['{:+.0f} km/s'.format(v) for v in velocities])
+
+        number, height, width = rgb.shape[:3]
+        if columns is None:
+            columns = int(np.ceil(np.sqrt(number)))
+        rows = int(np.ceil(number / float(columns)))
+
+        # Pad out the last row with blank panels, with a gutter between them
+        gutter = 2
+        background = np.array(self.cmap.get_bad()[:3]) * 255
+        grid = np.empty((rows, height + gutter, columns, width + gutter, 3), dtype=np.uint8)
+        grid[:] = background.astype(np.uint8)
+
+        padded = np.empty((rows * columns, height, width, 3), dtype=np.uint8)
+        padded[:] = background.astype(np.uint8)
+        padded[:number] = rgb
+        grid[:, :height, :, :width] = padded.reshape(
+            rows, columns, height, width, 3).transpose(0, 2, 1, 3, 4)
+
+        return grid.reshape(rows * (height + gutter), columns * (width + gutter), 3)[:-gutter, :-gutter]
+
+    def quantize(self, image):
+        '''Stretch one image and look it up in the colormap, as an RGB uint8
+        array the same way up as the image.
+
+        This is what imshow does with norm and cmap, pixel for pixel: the
+        stretch runs from vmin to vmax, or the range of the image where
+        those aren't set, and NaNs (and on a log stretch, anything that
+        isn't positive) are the background color. Every step writes into
+        buffers that are reused for every frame, so the RGB array is
+        overwritten by the next one.
+        '''
+
+        if getattr(self, '_lut', None) is None:
+            self._lut = self.cmap(np.arange(self.cmap.N), bytes=True)[:, :3]
+            self._bad = (np.array(self.cmap.get_bad()[:3]) * 255).astype(np.uint8)
+
+        scaled = self.buffer('scaled', np.float32)
+        blank = self.buffer('unstretched', bool)
+        positive = self.buffer('positive', bool)
+        index = self.buffer('index', np.uint8)
+        rgb = self.buffer('rgb', np.uint8, shape=image.shape + (3,))
+
+        np.copyto(scaled, image)
+        np.isfinite(scaled, out=blank)
+        if self.linear is not True:
+            with np.errstate(invalid='ignore'):
+                np.greater(scaled, 0, out=positive)
+            np.logical_and(blank, positive, out=blank)
+        np.logical_not(blank, out=blank)
+        np.copyto(scaled, np.nan, where=blank)
+
+        with np.errstate(all='ignore'):
+            vmin = vmax = None
+            if not blank.all():
+                vmin = np.float32(self.vmin if self.vmin is not None else np.nanmin(scaled))
+                vmax = np.float32(self.vmax if self.vmax is not None else np.nanmax(scaled))
+
+            if vmin is None or vmax == vmin:
+                # A flat (or empty) image is all the bottom color
+                scaled[...] = 0
+            else:
+                if self.linear is not True:
+                    np.log10(scaled, out=scaled)
+                    vmin, vmax = np.log10(vmin), np.log10(vmax)
+                scaled -= vmin
+                scaled /= vmax - vmin
+                scaled *= self.cmap.N
+                np.floor(scaled, out=scaled)
+                np.copyto(scaled, 0, where=blank)
+                np.clip(scaled, 0, self.cmap.N - 1, out=scaled)
+
+        np.copyto(index, scaled, casting='unsafe')
+        np.take(self._lut, index, axis=0, out=rgb)
+        np.copyto(rgb, self._bad, where=blank[:, :, np.newaxis])
+
+        return rgb
+
+    def render(self, image):
+        '''Render one image to an RGB array'''
+
+        rgb = self.quantize(image)
+
+        # The figure is made once, for the first frame, and only its
+        # pixels are swapped after that
+        if self._canvas is None:
+            sizes = np.shape(image)
+            # Scale up the image by the scalefactor - higher means a larger GIF
+            # movie, in MB and inches.
+            height = float(sizes[0]) * self.scalefactor
+            width = float(sizes[1]) * self.scalefactor
+
+            # Draw straight onto an Agg canvas rather than going through pyplot
+            # and a .png on disk.
+            fig = Figure(figsize=(width / height, 1), dpi=height)
+            self._canvas = FigureCanvasAgg(fig)
+            ax = fig.add_axes([0., 0., 1., 1.])
+            ax.set_axis_off()
+
+            self._artist = ax.imshow(rgb, origin='lower', interpolation='None')
+        else:
+            self._artist.set_data(rgb)
+
+        self._canvas.draw()
+        rgb = np.asarray(self._canvas.buffer_rgba())[:, :, :3].copy()
+
+        return rgb
+
+
+class CompositeFrames(MovieFrames):
+    '''A lazy sequence of RGB composite frames, one emission line per color.
+
+    centers is a list of three redshifted line centers, for red, green and
+    blue. The frames step through the green line's channels, and at every
+    frame each line is shown at the channel nearest the same velocity
+    offset. All three channel windows are read in one go, and each band
+    gets its own stretch, worked out once over all of its frames so the
+    colors hold steady through the movie. Frame channels and wavelengths are
+    (red, green, blue) tuples.
+    '''
+
+    def __init__(self, cube, centers, frames=30, thresh=None, scalefactor=3.0, vmin=None, vmax=None, contsub=False, background_color='black', linear=False, cache_dir=None):
+
+        if len(centers) != 3:
+            raise ValueError("An RGB composite needs exactly three lines, not {}.".format(len(centers)))
+
+        if isinstance(cube, tuple):
+            data, self.header = cube
+        else:
+            data, self.header = open_cube(cube, cache_dir=cache_dir)
+
+        wavelength = wavelength_array(self.header, data.shape[0])
+        low, high = min(wavelength[0], wavelength[-1]), max(wavelength[0], wavelength[-1])
+        colors = ('red', 'green', 'blue')
+
+        # The green line sets the velocity of each frame...
+        self.center = centers[1]
+        check_wavelength(self.center, wavelength, "The green line at {} Angstroms".format(
+            round(float(self.center), 1)))
+        self.center_channel = int((np.abs(wavelength - self.center)).argmin())
+        check_window(self.center_channel - frames, self.center_channel + frames,
+                     data.shape[0], "The green line at {} Angstroms".format(round(float(self.center), 1)))
+        green = np.arange(self.center_channel - frames,
+                          self.center_channel + frames, 1)
+        self.velocities = C_KMS * (wavelength[green] - self.center) / self.center
+
+        # ...and the other two follow at the same velocities
+        self.channels = np.empty((len(green), 3), dtype=int)
+        for band, center in enumerate(centers):
+            matched = center * (1 + self.velocities / C_KMS)
+            # Rather than clamping to the nearest end of the cube
+            if matched.min() < low or matched.max() > high:
+                raise ValueError("The {} line at {} Angstroms needs {} to {} Angstroms, but the cube covers {} to {}.".format(
+                    colors[band], round(float(center), 1), round(float(matched.min()), 1),
+                    round(float(matched.max()), 1), round(float(low), 1), round(float(high), 1)))
+            self.channels[:, band] = np.abs(
+                wavelength[np.newaxis, :] - matched[:, np.newaxis]).argmin(axis=1)
+        self.wavelengths = wavelength[self.channels]
+
+        windows = [(self.channels[:, band].min(), self.channels[:, band].max() + 1)
+                   for band in range(3)]
+        center_channels = [int((np.abs(wavelength - center)).argmin())
+                           for center in centers]
         if contsub is True:
-            final_image_data = data[slice, :, :] - \
-                data[center_channel - 200, :, :]
-        elif contsub is False:
-            final_image_data = data[slice, :, :]
-
-        if thresh is not None:
-            final_image_data[final_image_data < thresh] = np.nan
-
-        sizes = np.shape(final_image_data)
-        height = float(sizes[0]) * scalefactor
-        width = float(sizes[1]) * scalefactor
-
-        fig = plt.figure()
-        fig.set_size_inches(width / height, 1, forward=False)
-        ax = plt.Axes(fig, [0., 0., 1., 1.])
-        ax.set_axis_off()
-        fig.add_axes(ax)
-
-        # cmap = sns.cubehelix_palette(20, light=0.95, dark=0.15, as_cmap=True)
-        cmap = cm.plasma
-        if whitebg is True:
-            cmap.set_bad('white', 1)
+            for band, c in enumerate(center_channels):
+                if c - CONTINUUM_OFFSET < 0:
+                    raise ValueError("The {} line needs channel {} for the continuum subtraction, which is off the cube.".format(
+                        colors[band], c - CONTINUUM_OFFSET))
+            windows += [(c - CONTINUUM_OFFSET, c - CONTINUUM_OFFSET + 1) for c in center_channels]
+
+        slab = Slab(data, windows)
+
+        self.bands = []
+        self.limits = []
+        for band in range(3):
+            channels = self.channels[:, band]
+            first = channels.min()
+            block = np.array(slab[first:channels.max() + 1],
+                             dtype=np.float32)[channels - first]
+
+            # Perform a dumb continuum subtraction.
+            # Risky if you land on another line.
+            if contsub is True:
+                block -= slab[center_channels[band] - CONTINUUM_OFFSET]
+
+            if thresh is not None:
+                block[block < thresh] = np.nan
+
+            self.bands.append(block)
+            self.limits.append(band_limits(block, vmin, vmax, linear))
+
+        self.scalefactor = scalefactor
+        self.linear = linear
+        self.background = np.array(to_rgb(background_color)) * 255
+
+        self.overlay_options = None
+        self._rendered = {}
+
+    def metadata(self, index):
+        return (tuple(int(c) for c in self.channels[index]),
+                tuple(float(w) for w in self.wavelengths[index]),
+                float(self.velocities[index]))
+
+    def image(self, index):
+        '''The stretched (y, x, 3) image for one frame, with NaNs where no line is'''
+
+        return np.stack([stretch(self.bands[band][index], *self.limits[band],
+                                 linear=self.linear)
+                         for band in range(3)], axis=-1)
+
+    def render(self, image):
+
+        blank = np.all(np.isnan(image), axis=-1)
+        rgb = np.nan_to_num(image) * 255
+        rgb[blank] = self.background
+
+        # Flip so row 0 is at the bottom, like imshow(origin='lower')
+        rgb = upscale(rgb[::-1], self.scalefactor)
+
+        return rgb.astype(np.uint8)
+
+
+def band_limits(block, vmin=None, vmax=None, linear=False):
+    '''Stretch limits for a stack of images, from percentiles unless given'''
+
+    if linear is True:
+        finite = block[np.isfinite(block)]
+    else:
+        # Only positive values mean anything on a log stretch
+        finite = block[np.isfinite(block) & (block > 0)]
+
+    if len(finite) == 0:
+        return (vmin or 1.0, vmax or 10.0)
+
+    low, high = np.percentile(finite, [1.0, 99.5])
+
+    if vmin is not None:
+        low = vmin
+    if vmax is not None:
+        high = vmax
+    if high <= low:
+        high = low * 10.0 if low > 0 else low + 1.0
+
+    return (low, high)
+
+
+def quantize_limits(thresh=None, vmax=None, contsub_floor=None, continuum=None, linear=False):
+    '''The (low, high) range of a line's channels that its frames can tell
+    apart, for quantizing them (see cubeio.quantize).
+
+    Anything under thresh (or contsub_floor, with a continuum), or on a log
+    stretch under zero, is blanked, and anything over vmax is the top
+    color. continuum is the (y, x) channel subtracted from the frames, or
+    a (channels, y, x) stack of the ones it could be; the limits are then
+    (y, x) images, offset by the continuum at each pixel. Either end is
+    None where there's no limit.
+    '''
+
+    cuts = [thresh]
+    if continuum is not None:
+        cuts.append(contsub_floor)
+    if linear is not True:
+        cuts.append(0.0)
+    cuts = [cut for cut in cuts if cut is not None]
+
+    low = max(cuts) if len(cuts) > 0 else None
+    high = vmax
+
+    if continuum is not None:
+        continuum = np.asarray(continuum, dtype=np.float32)
+        lowest = highest = continuum
+        if continuum.ndim == 3:
+            lowest = np.fmin.reduce(continuum, axis=0)
+            highest = np.fmax.reduce(continuum, axis=0)
+        if low is not None:
+            low = np.float32(low) + lowest
+        if high is not None:
+            high = np.float32(high) + highest
+
+    return low, high
+
+
+def stretch(image, vmin, vmax, linear=False):
+    '''Scale an array to 0-1 between vmin and vmax. NaNs stay NaN.'''
+
+    if linear is True:
+        scaled = (image - vmin) / (vmax - vmin)
+    else:
+        scaled = np.log10(np.maximum(image, vmin) / vmin) / np.log10(vmax / vmin)
+
+    return np.clip(scaled, 0.0, 1.0)
+
+
+def upscale(image, scalefactor):
+    '''Nearest-neighbour resize of a (y, x, ...) array by scalefactor'''
+
+    height = int(round(image.shape[0] * scalefactor))
+    width = int(round(image.shape[1] * scalefactor))
+
+    rows = ((np.arange(height) + 0.5) * image.shape[0] / height).astype(int)
+    columns = ((np.arange(width) + 0.5) * image.shape[1] / width).astype(int)
+
+    return image[rows[:, np.newaxis], columns[np.newaxis, :]]
+
+
+def area_weights(size, new_size):
+    '''A (new_size, size) matrix that shrinks an axis of size pixels to
+    new_size by area averaging: each new pixel is the mean of the old
+    pixels it covers, counting the ones cut by its edges fractionally'''
+
+    edges = np.arange(new_size + 1) * size / float(new_size)
+    pixels = np.arange(size)
+
+    overlap = np.minimum(edges[1:, np.newaxis], pixels[np.newaxis, :] + 1) - \
+        np.maximum(edges[:-1, np.newaxis], pixels[np.newaxis, :])
+
+    return np.clip(overlap, 0, None) * new_size / float(size)
+
+
+def downscale(image, height, width):
+    '''Area-averaging resize of a (y, x, ...) uint8 frame down to height x width'''
+
+    if image.shape[:2] == (height, width):
+        return image
+
+    rows = area_weights(image.shape[0], height)
+    columns = area_weights(image.shape[1], width)
+
+    # Both axes at once, as two matrix products
+    shrunk = np.tensordot(rows, image.astype(np.float32), axes=(1, 0))
+    shrunk = np.tensordot(columns, shrunk, axes=(1, 1)).swapaxes(0, 1)
+
+    return np.rint(shrunk).astype(np.uint8)
+
+
+def size_scalefactors(sizes, width):
+    '''The scale factor for each of sizes, for frames from a cube width
+    pixels across. A size is a scale factor (1.5) or a width in pixels
+    (400px).'''
+
+    scalefactors = []
+    for size in sizes:
+        size = str(size)
+        if size.endswith('px'):
+            scalefactors.append(float(size[:-2]) / width)
         else:
-            cmap.set_bad('black', 1)
+            scalefactors.append(float(size))
+
+    return scalefactors
+
+
+def line_movies(cube, centers, frames=30, contsub=False, cache_dir=None, find_line=False, search_width=50.0, snr=None, **kwargs):
+    '''MovieFrames for several emission lines, from a single read of the cube.
+
+    Works out the channel window each line needs (its frames, plus its
+    continuum channel and line search window if those are used), merges the
+    windows that overlap, and reads the union into one shared Slab. Every
+    movie is then rendered from that, so nothing is read twice. Takes the
+    same keyword arguments as MovieFrames.
+
+    A line whose window runs off the cube is skipped, with a message, and
+    its place in the list is None.
+    '''
+
+    data, header = open_cube(cube, cache_dir=cache_dir)
+
+    wavelength = wavelength_array(header, data.shape[0])
+
+    # The channels a movie centered on center needs
+    velocity_grid = kwargs.get('velocity_grid')
+
+    def movie_window(center):
+        if velocity_grid is None:
+            center_channel = int((np.abs(wavelength - center)).argmin())
+            return (center_channel - frames, center_channel + frames)
+        positions = grid_channels(velocity_array(header, wavelength, center),
+                                  grid_velocities(*velocity_grid))
+        return (int(np.floor(positions.min())),
+                min(int(np.floor(positions.max())) + 2, len(wavelength)))
+
+    # Quantized channels are limited to what each line's frames can show,
+    # and continuum channels kept exact, as MovieFrames.load does
+    precision = kwargs.get('precision', 'float32')
+    limited = precision == 'uint16' and snr is None and kwargs.get('binning') is None and \
+        kwargs.get('interp', 0) == 0 and velocity_grid is None
+
+    windows = []
+    limits = []
+    continua = []
+    usable = []
+    for center in centers:
+        what = "The line at {} Angstroms".format(round(float(center), 1))
+        try:
+            if find_line is True:
+                search = np.flatnonzero(np.abs(wavelength - center) <= search_width)
+                if len(search) == 0:
+                    raise ValueError("{} is more than {} Angstroms off the cube.".format(what, search_width))
+                # The line could be anywhere in the search window
+                window = (movie_window(wavelength[search[0]])[0],
+                          movie_window(wavelength[search[-1]])[1])
+                center_channels = [search[0], search[-1]]
+            else:
+                check_wavelength(center, wavelength, what)
+                window = movie_window(center)
+                center_channels = [int((np.abs(wavelength - center)).argmin())]
+            check_window(window[0], window[1], data.shape[0], what,
+                         center_channels[0] - CONTINUUM_OFFSET if contsub is True else None)
+        except ValueError as error:
+            print("{} Skipping it.".format(error))
+            usable.append(False)
+            continue
+
+        usable.append(True)
+        windows.append(window)
+        if contsub is True:
+            for channel in range(center_channels[0], center_channels[-1] + 1):
+                windows.append((channel - CONTINUUM_OFFSET, channel - CONTINUUM_OFFSET + 1))
+                continua.append((channel - CONTINUUM_OFFSET, channel - CONTINUUM_OFFSET + 1))
+        if limited:
+            continuum = None
+            if contsub is True:
+                continuum = data[center_channels[0] - CONTINUUM_OFFSET:center_channels[-1] - CONTINUUM_OFFSET + 1]
+            low, high = quantize_limits(kwargs.get('thresh'), kwargs.get('vmax'),
+                                        kwargs.get('contsub_floor'), continuum,
+                                        linear=kwargs.get('linear', False))
+            limits.append(window + (low, high))
+
+    if not any(usable):
+        raise ValueError("None of the lines fit in {}.".format(cube))
+
+    slab = Slab(data, windows, cube=cube, precision=precision,
+                limits=limits if limited else None, exact=continua)
+    print("Read {} MB of channels for {} lines.".format(
+        round(slab.nbytes / 1e6, 1), sum(usable)))
+
+    # The same channels of the variance, for S/N thresholding
+    variance = None
+    if snr is not None:
+        variance = Slab(open_variance(cube, cache_dir=cache_dir), windows)
+
+    movies = []
+    if kwargs.get('render_cache') is not None:
+        kwargs['fingerprint'] = cube_fingerprint(cube)
+
+    for center, fit in zip(centers, usable):
+        if not fit:
+            movies.append(None)
+            continue
+        movies.append(MovieFrames((slab, header), center, frames=frames,
+                                  contsub=contsub, find_line=find_line,
+                                  search_width=search_width, snr=snr,
+                                  variance=variance, **kwargs))
+
+    return movies
+
+
+def write_gif(movie, gif_name):
+    '''Stream the frames of a movie into a GIF'''
+
+    # Remove any old GIFs you might have made
+    if os.path.isfile(gif_name):
+        os.remove(gif_name)
 
-        if linear is True:
-            ax.imshow(final_image_data, origin='lower', vmin=vmin,
-                      vmax=vmax, cmap=cmap, interpolation='None')
-        elif linear is False:
-            ax.imshow(final_image_data, origin='lower',
-                      norm=LogNorm(), vmin=vmin, vmax=vmax, cmap=cmap, interpolation='None')
+    with imageio.get_writer(gif_name, mode='I') as writer:
+        for frame in progressbar(movie):
+            writer.append_data(frame.image)
 
-        fig.subplots_adjust(bottom=0)
-        fig.subplots_adjust(top=1)
-        fig.subplots_adjust(right=1)
-        fig.subplots_adjust(left=0)
 
-        fig.savefig(temp_movie_dir + '{}'.format(i) + '.png', dpi=height)
-        png_files.append(temp_movie_dir + '{}'.format(i) + '.png')
-        plt.close(fig)
+def write_gifs(movie, outputs):
+    '''Write one movie as several GIFs of different sizes.
 
-    # Create and scrub the GIF directory
+    outputs is a list of (gif_name, (height, width)), none of them bigger
+    than the movie's own frames. Every frame is rendered once, and shrunk
+    to each size with downscale. Each GIF is shrunk and encoded in its own
+    thread.
+    '''
+
+    frames = [frame.image for frame in progressbar(movie)]
+
+    def encode(output):
+        gif_name, (height, width) = output
+        if os.path.isfile(gif_name):
+            os.remove(gif_name)
+        with imageio.get_writer(gif_name, mode='I') as writer:
+            for image in frames:
+                writer.append_data(downscale(image, height, width))
+
+    with ThreadPoolExecutor(max_workers=len(outputs)) as pool:
+        list(pool.map(encode, outputs))
+
+
+def makeMovie(cube, redshift, center, name, thresh=None, frames=30, scalefactor=3.0, vmin=None, vmax=None, contsub=False, whitebg=False, linear=False, cache_dir=None, find_line=False, search_width=50.0, search_region='core', moments=False, snr=None, snr_smooth=None, binning=None, target_snr=10.0, overlay=None, interp=0, channel_map=None, channel_map_columns=None, render_cache=None, render_cache_size=2.0, sizes=None, velocity_grid=None, precision='float32'):
+    '''Make the movie.
+
+    center can also be a dictionary of {label: center} for several emission
+    lines, in which case the cube is read once and you get one movie per
+    line, named "<name>_<label>". overlay is a dictionary of keyword
+    arguments for MovieFrames.add_overlay. sizes replaces scalefactor with
+    several sizes, all written from one render (see saveMovie).
+    velocity_grid=(low, high, step) in km/s puts the frames on a fixed
+    velocity grid rather than the cube's channels. precision='uint16' holds
+    the channels quantized (see cubeio.quantize).
+    '''
+
+    if whitebg is True:
+        background_color = 'white'
+    else:
+        background_color = 'black'
+
+    # Render at the largest size, and shrink from there
+    if sizes is not None:
+        scalefactor = max(size_scalefactors(sizes, read_header(cube)[0][2]))
+
+    options = dict(frames=frames, thresh=thresh, scalefactor=scalefactor,
+                   vmin=vmin, vmax=vmax, contsub=contsub, cmap=cm.plasma,
+                   background_color=background_color, linear=linear,
+                   cache_dir=cache_dir, find_line=find_line,
+                   search_width=search_width, search_region=search_region,
+                   snr=snr, snr_smooth=snr_smooth, binning=binning,
+                   target_snr=target_snr, interp=interp,
+                   velocity_grid=velocity_grid, precision=precision)
+
+    # Frames are reused from earlier runs with the same settings
+    if render_cache is not None:
+        options['render_cache'] = RenderCache(render_cache,
+                                              max_bytes=int(render_cache_size * 1024 ** 3))
+
+    if isinstance(center, dict):
+        labels = list(center)
+        movies = line_movies(cube, [center[label] for label in labels],
+                             **options)
+        for label, movie in zip(labels, movies):
+            if movie is None:
+                continue
+            if overlay is not None:
+                movie.add_overlay(**overlay)
+            saveMovie(movie, redshift, center[label], "{}_{}".format(name, label),
+                      find_line=find_line, moments=moments, channel_map=channel_map,
+                      channel_map_columns=channel_map_columns, sizes=sizes)
+        return movies
+
+    movie = MovieFrames(cube, center, **options)
+    if overlay is not None:
+        movie.add_overlay(**overlay)
+    saveMovie(movie, redshift, center, name, find_line=find_line,
+              moments=moments, channel_map=channel_map,
+              channel_map_columns=channel_map_columns, sizes=sizes)
+
+    return movie
+
+
+def write_moment_maps(movie, basename, cmap=cm.plasma):
+    '''Write moment 0, 1 and 2 maps as <basename>_mom*.fits and .png'''
+
+    # Keep the celestial WCS of the cube, dropping the spectral axis
+    wcs = WCS(movie.header).dropaxis(2)
+    unit = movie.header.get('BUNIT', '')
+
+    moments = movie.moment_maps()
+
+    for number, moment in enumerate(moments):
+        header = wcs.to_header()
+        header['BUNIT'] = '{} km/s'.format(unit).strip() if number == 0 else 'km/s'
+        if movie.center is not None:
+            header['LINECEN'] = (movie.center, 'Line center (Angstrom)')
+        fits.PrimaryHDU(moment.astype(np.float32), header=header).writeto(
+            '{}_mom{}.fits'.format(basename, number), overwrite=True)
+
+    finite = np.isfinite(moments[1])
+    if finite.any():
+        extent = np.percentile(np.abs(moments[1][finite]), 98)
+    else:
+        extent = 1.0
+
+    imsave('{}_mom0.png'.format(basename), moments[0], origin='lower',
+           cmap=cmap.with_extremes(bad='black'))
+    imsave('{}_mom1.png'.format(basename), moments[1], origin='lower',
+           cmap=cm.RdBu_r.with_extremes(bad='black'), vmin=-extent, vmax=extent)
+    imsave('{}_mom2.png'.format(basename), moments[2], origin='lower',
+           cmap=cm.viridis.with_extremes(bad='black'))
+
+    print("Saved moment maps to {}_mom[012].fits/.png".format(basename))
+
+
+def makeCompositeMovie(cube, redshift, centers, name, thresh=None, frames=30, scalefactor=3.0, vmin=None, vmax=None, contsub=False, whitebg=False, linear=False, cache_dir=None, overlay=None, sizes=None):
+    '''Make an RGB composite movie of three lines (red, green, blue centers)'''
+
+    if whitebg is True:
+        background_color = 'white'
+    else:
+        background_color = 'black'
+
+    if sizes is not None:
+        scalefactor = max(size_scalefactors(sizes, read_header(cube)[0][2]))
+
+    movie = CompositeFrames(cube, centers, frames=frames, thresh=thresh,
+                            scalefactor=scalefactor, vmin=vmin, vmax=vmax,
+                            contsub=contsub, background_color=background_color,
+                            linear=linear, cache_dir=cache_dir)
+    if overlay is not None:
+        movie.add_overlay(**overlay)
+
+    saveMovie(movie, redshift, centers[1], name, sizes=sizes)
+
+    return movie
+
+
+def saveMovie(movie, redshift, center, name, find_line=False, moments=False, channel_map=None, channel_map_columns=None, sizes=None):
+    '''Write a movie to movies/<name>.gif, and optionally its moment maps and
+    a channel map of every channel_map-th channel.
+
+    With sizes (scale factors, or widths like 400px), it's written once per
+    size instead, all from the movie's frames: the first size to
+    movies/<name>.gif as usual, and the rest to movies/<name>_<size>.gif.
+    The movie should have been made at the largest of the sizes.
+    '''
+
+    if find_line is True:
+        restwav = center / (1 + redshift)
+        redshift = movie.center / restwav - 1
+        print("Found the line at {} Angstroms (expected {}), which implies z={}".format(
+            round(movie.center, 2), round(center, 2), round(redshift, 5)))
+
+    print("Making movie for {} at z={}. Line centroid is in channel {}".format(
+        name, round(redshift, 3), movie.center_channel))
+
+    # Create the GIF directory
     gif_output_dir = "movies/"
     if not os.path.exists(gif_output_dir):
         os.makedirs(gif_output_dir)
         print("Saving output movies to '{}'.".format(gif_output_dir))
 
     gif_name = gif_output_dir + '{}.gif'.format(name)
-    gif_frames = []
 
-    # Remove any old GIFs you might have made
-    if os.path.isfile(gif_name):
-        os.remove(gif_name)
+    # Everything made from the slab as well as the frames comes from one read
+    if moments is True or channel_map is not None:
+        movie.load()
+
+    if sizes is None:
+        write_gif(movie, gif_name)
+        print("Done. Saving movie to {}.".format(gif_name))
+    else:
+        height, width = movie[0].image.shape[:2]
+        ny, nx = movie.header['NAXIS2'], movie.header['NAXIS1']
+        scalefactors = size_scalefactors(sizes, nx)
+
+        outputs = []
+        for index, (size, scalefactor) in enumerate(zip(sizes, scalefactors)):
+            if scalefactor == max(scalefactors):
+                shape = (height, width)
+            else:
+                shape = (min(int(round(ny * scalefactor)), height),
+                         min(int(round(nx * scalefactor)), width))
+            # The first size keeps the name a plain -s run would give it
+            if index == 0:
+                outputs.append((gif_name, shape))
+            else:
+                outputs.append((gif_output_dir + '{}_{}.gif'.format(name, size), shape))
+
+        write_gifs(movie, outputs)
+        for gif_name, shape in outputs:
+            print("Done. Saving movie to {} ({}x{}).".format(gif_name, shape[1], shape[0]))
+
+    if movie.render_cache is not None:
+        print("Reused {} of {} frames from the render cache.".format(
+            movie.cache_hits, len(movie)))
 
-    for filename in png_files:
-        gif_frames.append(imageio.imread(filename))
+    if moments is True:
+        write_moment_maps(movie, gif_output_dir + name)
 
-    imageio.mimsave(gif_name, gif_frames)
-    print("Done. Saving movie to {}.".format(gif_name))
+    if channel_map is not None:
+        chanmap_name = gif_output_dir + '{}_chanmap.png'.format(name)
+        imsave(chanmap_name, movie.channel_map(step=channel_map, columns=channel_map_columns))
+        print("Saved a channel map of every {} channels to {}".format(channel_map, chanmap_name))
+
+
+def convert_main(argv):
+    '''The `musemovie.py convert` command'''
+
+    parser = argparse.ArgumentParser(prog='musemovie.py convert',
+                                     description='Re-lay a FITS cube into a chunked, compressed HDF5 store for fast slab, cutout and spectrum access')
+
+    parser.add_argument(
+        'cube', help="Name of or full path to a MUSE datacube.")
+    parser.add_argument('store', help="Output store (.h5 or .hdf5)")
+    parser.add_argument('--chunks', help="Chunk shape as (channels, y, x)",
+                        nargs=3, type=int, default=list(DEFAULT_CHUNKS))
+    parser.add_argument('--compression', help="Compression filter",
+                        choices=['gzip', 'lzf', 'none'], default='gzip')
+    parser.add_argument('--level', help="gzip compression level (0-9)",
+                        type=int, default=4)
+
+    args = parser.parse_args(argv)
+
+    print("Converting {} to {} with {} chunks.".format(
+        args.cube, args.store, tuple(args.chunks)))
+    convert_cube(args.cube, args.store, chunks=tuple(args.chunks),
+                 compression=args.compression, level=args.level)
+    print("Done.")
+
+
+def quicklook_main(argv):
+    '''The `musemovie.py quicklook` command'''
+
+    parser = argparse.ArgumentParser(prog='musemovie.py quicklook',
+                                     description='A contact sheet of every science cube in a directory, from a few channels of each')
+
+    parser.add_argument('directory', help="Directory of MUSE datacubes")
+    parser.add_argument('-r', '--restwav', help="Rest wavelength or name of the line to look at",
+                        default='6563.0')
+    parser.add_argument('-z', '--redshift', help="Redshift to use for every cube. Without this (or --catalog) you get white light thumbnails",
+                        default=None, type=float)
+    parser.add_argument('--catalog', help="Local redshift catalog (name, ra, dec, z) to look up each target's redshift in",
+                        default=None)
+    parser.add_argument('--aliases', help="alias,name CSV of target name corrections",
+                        default=DEFAULT_ALIASES)
+    parser.add_argument('-o', '--output', help="Output basename, for the .png sheet and .csv index",
+                        default='quicklook')
+    parser.add_argument('--size', help="Thumbnail size, in pixels",
+                        type=int, default=128)
+    parser.add_argument('--samples', help="Channels to read from each cube",
+                        type=int, default=5)
+    parser.add_argument('--stride', help="Spacing of those channels around the line",
+                        type=int, default=4)
+    parser.add_argument('--workers', help="Cubes to read at once",
+                        type=int, default=8)
+    parser.add_argument('--cache-dir', help="Directory to cache decompressed copies of gzipped cubes in",
+                        default=None)
+
+    args = parser.parse_args(argv)
+
+    restwav = list(parse_lines([args.restwav]).values())[0]
+
+    name_dictionary, coordinate_dictionary = construct_filename_dictionaries(
+        os.path.join(args.directory, ''), load_aliases(args.aliases))
+
+    if args.catalog is not None:
+        redshifts = RedshiftCatalog(args.catalog, aliases=args.aliases).resolve(
+            coordinate_dictionary)
+    elif args.redshift is not None:
+        redshifts = {name: args.redshift for name in coordinate_dictionary}
+    else:
+        redshifts = {}
+
+    centers = {}
+    for filename, name in name_dictionary.items():
+        if name in redshifts:
+            centers[filename] = restwav * (1 + redshifts[name])
+
+    print("Making a contact sheet of {} cubes.".format(len(name_dictionary)))
+    sheet = contact_sheet(name_dictionary, args.output, centers=centers, samples=args.samples,
+                          stride=args.stride, size=args.size, workers=args.workers,
+                          cache_dir=args.cache_dir)
+    if sheet is not None:
+        print("Saved {0}.png and {0}.csv".format(args.output))
+
+
+def serve_main(argv):
+    '''The `musemovie.py serve` command'''
+
+    from preview import Preview, serve
+
+    parser = argparse.ArgumentParser(prog='musemovie.py serve',
+                                     description='Tune a movie in the browser: frames are rendered as you change the settings')
+
+    parser.add_argument('cube', help="Name of or full path to a MUSE datacube")
+    parser.add_argument('-z', '--redshift', help="Redshift of the object", default=0, type=float)
+    parser.add_argument('-r', '--restwav', help="Rest wavelength or name of the emission line",
+                        default='6563.0')
+    parser.add_argument('-n', '--name', help="Target name", type=str, default=None)
+    parser.add_argument('-f', '--frames', help="Number of frames either side of the line", default=30, type=int)
+    parser.add_argument('-s', '--scalefactor', help="Scale factor for the exported command",
+                        default=3.0, type=float)
+    parser.add_argument('--preview-scale', help="Scale factor of the frames shown in the browser",
+                        default=1.0, type=float)
+    parser.add_argument('-t', '--thresh', help="Starting threshold", default=None, type=float)
+    parser.add_argument('--vmin', help="Starting vmin", type=float, default=None)
+    parser.add_argument('--vmax', help="Starting vmax", type=float, default=None)
+    parser.add_argument('--contsub', default=False, action='store_true')
+    parser.add_argument('--white', default=False, action='store_true')
+    parser.add_argument('--linear', default=False, action='store_true')
+    parser.add_argument('--port', help="Port to serve on", type=int, default=8000)
+    parser.add_argument('--cache-size', help="Rendered frames to keep", type=int, default=512)
+    parser.add_argument('--cache-dir', help="Directory to cache decompressed copies of gzipped cubes in",
+                        default=None)
+
+    args = parser.parse_args(argv)
+
+    restwav = list(parse_lines([args.restwav]).values())[0]
+    settings = dict(thresh=args.thresh, vmin=args.vmin, vmax=args.vmax,
+                    linear=args.linear, contsub=args.contsub, white=args.white)
+
+    preview = Preview(args.cube, redshift=args.redshift, restwav=restwav, name=args.name,
+                      frames=args.frames, scalefactor=args.scalefactor,
+                      preview_scale=args.preview_scale, cache_size=args.cache_size,
+                      cache_dir=args.cache_dir, settings=settings)
+    serve(preview, port=args.port)
 
 
 def main():
 
+    # Subcommands. Anything else is treated as a cube to make a movie from.
+    if len(sys.argv) > 1 and sys.argv[1] == 'convert':
+        convert_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'quicklook':
+        quicklook_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description='Make a movie of a MUSE cube')
 
     parser.add_argument(
-        'cube', help="Name of or full path to a MUSE datacube.")
+        'cube', help="Name of or full path to a MUSE datacube, or a store made with `musemovie.py convert`.")
     parser.add_argument('-z', '--redshift',
                         help="Redshift of the object", default=0, type=float)
     parser.add_argument(
-        '-r', '--restwav', help="Rest wavelength of the emission line", default=6563.0, type=float)
+        '-r', '--restwav', help="Rest wavelength of the emission line. Give several (wavelengths, line names like Halpha or OIII5007, or line sets like NII-Halpha-SII) to make one movie per line from a single read of the cube", default=['6563.0'], nargs='+')
     parser.add_argument('-n', '--name', help="Target name",
                         type=str, default=None)
     parser.add_argument('-t', '--thresh', default=None, type=float)
@@ -162,6 +1559,8 @@ def main():
         '-f', '--frames', help="Number of frames in your movie", default=30, type=int)
     parser.add_argument('-s', '--scalefactor',
                         help="Scale factor for GIF DPI", default=3.0, type=float)
+    parser.add_argument('--sizes', help="Write the movie at several sizes from one render: scale factors, or widths in pixels like 400px; the first is written to <name>.gif, the rest to <name>_<size>.gif (replaces -s)",
+                        nargs='+', default=None)
     parser.add_argument('--contsub', help="Perform continuum subtraction?",
                         default=False, action='store_true')
     parser.add_argument('--white', help="Set a white background instead?",
@@ -175,6 +1574,51 @@ def main():
     parser.add_argument('--vmax', help="Maximum pixel value for color bar",
                         type=float, default=None)
 
+    parser.add_argument('--cache-dir', help="Decompress gzipped cubes into this directory once, and memory-map the copy on later runs",
+                        type=str, default=None)
+
+    parser.add_argument('--find-line', help="Center the movie on the emission line peak found in the data, rather than trusting the redshift",
+                        default=False, action='store_true')
+    parser.add_argument('--search-width', help="With --find-line, search this many Angstroms either side of the expected line",
+                        type=float, default=50.0)
+    parser.add_argument('--search-region', help="With --find-line, build the spectrum from the bright core or the whole field",
+                        choices=['core', 'field'], default='core')
+
+    parser.add_argument('--snr', help="Mask pixels below this signal-to-noise, using the cube's STAT variance extension",
+                        type=float, default=None)
+    parser.add_argument('--snr-smooth', help="With --snr, measure S/N in boxes of this many pixels on a side, so faint extended emission survives",
+                        type=int, default=None)
+    parser.add_argument('--binning', help="Adaptively bin the field toward --target-snr before thresholding, to bring out faint diffuse emission",
+                        choices=['quadtree', 'voronoi'], default=None)
+    parser.add_argument('--target-snr', help="With --binning, the S/N each bin should reach (summed over the movie's channels)",
+                        type=float, default=10.0)
+    parser.add_argument('--moments', help="Also save moment 0, 1 and 2 maps of the line (FITS and PNG)",
+                        default=False, action='store_true')
+    parser.add_argument('--channel-map', help="Also save a channel map grid of every N-th channel, with one shared stretch",
+                        type=int, default=None, metavar='N')
+    parser.add_argument('--channel-map-columns', help="Panels per row of the channel map (default: as square as possible)",
+                        type=int, default=None)
+    parser.add_argument('--render-cache', help="Directory to cache rendered frames in, so later runs only render frames whose settings changed",
+                        default=None)
+    parser.add_argument('--render-cache-size', help="Size limit of the render cache, in GB (least recently used frames are removed first)",
+                        type=float, default=2.0)
+    parser.add_argument('--velocity-grid', help="Put the frames on a fixed velocity grid around the line, from LOW to HIGH km/s in steps of STEP, so movies of different targets and lines match frame for frame (replaces -f)",
+                        nargs=3, type=float, default=None, metavar=('LOW', 'HIGH', 'STEP'))
+    parser.add_argument('--precision', help="Hold the channels in memory as float32, or quantized to scaled uint16 at half the size (see cubeio.quantize)",
+                        choices=['float32', 'uint16'], default='float32')
+    parser.add_argument('--interp', help="Interpolate this many extra frames between each pair of channels, for smooth slow motion",
+                        type=int, default=0)
+    parser.add_argument('--label', help="Label each frame with its velocity offset or wavelength",
+                        choices=['velocity', 'wavelength'], default=None)
+    parser.add_argument('--title', help="Put the target name on every frame",
+                        default=False, action='store_true')
+    parser.add_argument('--scalebar', help="Draw a scale bar this many arcsec long ('auto' picks one)",
+                        type=str, default=None)
+    parser.add_argument('--colorbar', help="Draw a colorbar (needs --vmin and --vmax)",
+                        default=False, action='store_true')
+    parser.add_argument('--rgb', help="Make an RGB composite movie instead, with these three lines (wavelengths or names) as red, green and blue",
+                        nargs=3, default=None)
+
     args = parser.parse_args()
 
     cube = args.cube
@@ -188,10 +1632,41 @@ def main():
     whitebg = args.white
     linear = args.linear
 
-    center = restwav * (1 + redshift)
+    overlay = None
+    if args.label is not None or args.title or args.scalebar is not None or args.colorbar:
+        scalebar = args.scalebar
+        if scalebar is not None and scalebar != 'auto':
+            scalebar = float(scalebar)
+        overlay = dict(title=name if args.title else None, label=args.label,
+                       scalebar=scalebar, colorbar=args.colorbar,
+                       color='black' if whitebg else 'white')
+
+    if args.rgb is not None:
+        lines = parse_lines(args.rgb)
+        centers = [line * (1 + redshift) for line in lines.values()]
+        makeCompositeMovie(cube, redshift, centers, name, thresh=thresh,
+                           frames=frames, scalefactor=scalefactor, vmin=args.vmin, vmax=args.vmax,
+                           contsub=contsub, whitebg=whitebg, linear=linear, cache_dir=args.cache_dir,
+                           overlay=overlay, sizes=args.sizes)
+        return
+
+    lines = parse_lines(restwav)
+
+    if len(lines) == 1:
+        center = list(lines.values())[0] * (1 + redshift)
+    else:
+        center = {label: line * (1 + redshift) for label, line in lines.items()}
 
     makeMovie(cube, redshift, center, name, thresh=thresh,
-              frames=frames, scalefactor=scalefactor, vmin=args.vmin, vmax=args.vmax, contsub=contsub, whitebg=whitebg, linear=linear)
+              frames=frames, scalefactor=scalefactor, vmin=args.vmin, vmax=args.vmax, contsub=contsub, whitebg=whitebg, linear=linear, cache_dir=args.cache_dir,
+              find_line=args.find_line, search_width=args.search_width, search_region=args.search_region,
+              moments=args.moments, snr=args.snr, snr_smooth=args.snr_smooth,
+              binning=args.binning, target_snr=args.target_snr, overlay=overlay,
+              interp=args.interp, channel_map=args.channel_map,
+              channel_map_columns=args.channel_map_columns,
+              render_cache=args.render_cache, render_cache_size=args.render_cache_size,
+              sizes=args.sizes, velocity_grid=args.velocity_grid,
+              precision=args.precision)
 
 
 if __name__ == '__main__':
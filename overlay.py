@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_rgb
+
+
+class GlyphCache(object):
+    '''Characters rasterized once each, to be pasted together into labels.
+
+    Every glyph is drawn in a monospace font into a cell of the same size,
+    so a label is just its glyphs' cells side by side. Only the first use of
+    a character touches matplotlib.
+    '''
+
+    def __init__(self, height, color='white'):
+
+        self.height = int(height)
+        self.width = int(round(height * 0.6))
+        self.color = color
+        self._glyphs = {}
+
+    def glyph(self, char):
+
+        if char not in self._glyphs:
+            fig = Figure(figsize=(self.width / 100.0, self.height / 100.0), dpi=100)
+            canvas = FigureCanvasAgg(fig)
+            fig.patch.set_alpha(0)
+            # Points are 1/72 inch, and the cell is drawn at 100 dpi
+            fig.text(0.5, 0.5, char, ha='center', va='center', color=self.color,
+                     family='monospace', fontsize=self.height * 0.72 * 0.8)
+            canvas.draw()
+            self._glyphs[char] = np.asarray(canvas.buffer_rgba(), dtype=np.float32) / 255.0
+
+        return self._glyphs[char]
+
+    def label(self, text):
+        '''An RGBA (height, width, 4) float array of some text'''
+
+        if len(text) == 0:
+            return np.zeros((self.height, 0, 4), dtype=np.float32)
+
+        return np.concatenate([self.glyph(char) for char in text], axis=1)
+
+
+class Overlay(object):
+    '''Text, a scale bar and a colorbar, composited onto RGB frames.
+
+    Everything that's the same on every frame (the title, the scale bar and
+    the colorbar) is rasterized once, into one RGBA layer the size of a
+    frame. Per-frame labels are pasted together from a GlyphCache. Both get
+    alpha-composited straight onto frame arrays, one frame or a whole
+    (frames, height, width, 3) stack at a time, so it works the same for
+    any renderer that produces RGB arrays.
+    '''
+
+    def __init__(self, shape, title=None, scalebar=None, pixscale=None, cmap=None, limits=None, color='white'):
+
+        self.height, self.width = shape[:2]
+
+        # Text is about 1/16 of the frame tall, but always readable
+        self.glyphs = GlyphCache(max(10, self.height // 16), color=color)
+        self.margin = max(2, self.height // 50)
+
+        self.static = np.zeros((self.height, self.width, 4), dtype=np.float32)
+
+        if title is not None:
+            self.paste(self.static, self.glyphs.label(title), self.margin, self.margin)
+
+        if scalebar is not None and pixscale is not None:
+            self.draw_scalebar(scalebar, pixscale, color)
+
+        if cmap is not None and limits is not None:
+            self.draw_colorbar(cmap, limits)
+
+    def paste(self, layer, rgba, top, left):
+        '''Paste an RGBA patch over a layer, clipped to the frame'''
+
+        bottom = min(top + rgba.shape[0], self.height)
+        right = min(left + rgba.shape[1], self.width)
+        if bottom <= top or right <= left:
+            return
+
+        patch = rgba[:bottom - top, :right - left]
+        alpha = patch[:, :, 3:]
+        region = layer[top:bottom, left:right]
+        region[:, :, :3] = patch[:, :, :3] * alpha + region[:, :, :3] * (1 - alpha)
+        region[:, :, 3:] = alpha + region[:, :, 3:] * (1 - alpha)
+
+    def draw_scalebar(self, arcsec, pixscale, color):
+        '''A bar of length arcsec, with its label, in the bottom left corner.
+
+        pixscale is in arcsec per frame pixel.
+        '''
+
+        length = int(round(arcsec / pixscale))
+        thickness = max(2, self.height // 80)
+
+        label = self.glyphs.label('{:g}"'.format(arcsec))
+
+        bar = np.zeros((thickness, length, 4), dtype=np.float32)
+        bar[:, :, :3] = to_rgb(color)
+        bar[:, :, 3] = 1.0
+
+        top = self.height - self.margin - thickness
+        self.paste(self.static, bar, top, self.margin)
+        self.paste(self.static, label, top - label.shape[0], self.margin)
+
+    def draw_colorbar(self, cmap, limits):
+        '''A horizontal colorbar with its limits, in the bottom right corner'''
+
+        length = self.width // 4
+        thickness = max(3, self.height // 40)
+
+        bar = np.repeat(cmap(np.linspace(0, 1, length))[np.newaxis, :, :],
+                        thickness, axis=0).astype(np.float32)
+
+        low = self.glyphs.label('{:.3g}'.format(limits[0]))
+        high = self.glyphs.label('{:.3g}'.format(limits[1]))
+
+        top = self.height - self.margin - thickness
+        left = self.width - self.margin - length
+        self.paste(self.static, bar, top, left)
+        self.paste(self.static, low, top - low.shape[0], left)
+        self.paste(self.static, high, top - high.shape[0],
+                   self.width - self.margin - high.shape[1])
+
+    def composite(self, frames, labels=None):
+        '''Composite the overlay onto one (height, width, 3) uint8 frame, or
+        a (frames, height, width, 3) stack, with a label per frame in the top
+        right corner'''
+
+        single = frames.ndim == 3
+        stack = frames[np.newaxis] if single else frames
+
+        if labels is None:
+            labels = [None] * len(stack)
+        elif single:
+            labels = [labels]
+
+        # The static layer goes onto every frame at once. Its colors are
+        # already multiplied by its alpha, as paste leaves them.
+        alpha = self.static[:, :, 3:]
+        out = stack.astype(np.float32) * (1 - alpha) + self.static[:, :, :3] * 255
+
+        for frame, label in zip(out, labels):
+            if label is None:
+                continue
+            rgba = self.glyphs.label(label)
+            top = self.margin
+            left = max(self.width - self.margin - rgba.shape[1], 0)
+            right = min(left + rgba.shape[1], self.width)
+            bottom = min(top + rgba.shape[0], self.height)
+            patch = rgba[:bottom - top, :right - left]
+            a = patch[:, :, 3:]
+            frame[top:bottom, left:right] = (frame[top:bottom, left:right] * (1 - a) +
+                                             patch[:, :, :3] * a * 255)
+
+        out = np.clip(out + 0.5, 0, 255).astype(np.uint8)
+
+        return out[0] if single else out
+
+
+def nice_scalebar(field_arcsec):
+    '''A round scale bar length, about a fifth of the field across'''
+
+    for length in (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600):
+        if length >= field_arcsec / 5.0:
+            return length
+
+    return 600
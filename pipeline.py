@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import threading
+
+from queue import Queue, Full
+
+# Marks the end of the items in the queue
+_DONE = object()
+
+
+def prefetch(items, load, depth=1):
+    '''Load items in a background thread while the caller works on the last.
+
+    Yields (item, load(item)) in order, like
+
+        for item in items:
+            yield item, load(item)
+
+    but with a reader thread running up to depth items ahead, so reading
+    cube N+1 overlaps with rendering and encoding cube N. The queue between
+    them is bounded, so at most depth loaded items wait in it (plus the one
+    the reader is holding and the one being worked on). An exception from
+    load is raised here, at its item. depth=0 loads in the caller's thread.
+    '''
+
+    if depth <= 0:
+        for item in items:
+            yield item, load(item)
+        return
+
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(entry):
+        # Give up if the caller stopped early, rather than blocking forever
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def reader():
+        for item in items:
+            try:
+                entry = (item, load(item), None)
+            except Exception as error:
+                entry = (item, None, error)
+            if not put(entry):
+                return
+        put(_DONE)
+
+    thread = threading.Thread(target=reader, name='prefetch', daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            entry = queue.get()
+            if entry is _DONE:
+                break
+            item, loaded, error = entry
+            if error is not None:
+                raise error
+            yield item, loaded
+    finally:
+        stop.set()
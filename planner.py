@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+from collections import namedtuple
+
+import numpy as np
+
+from cubeio import read_header, wavelength_array, velocity_array, grid_velocities, grid_channels, CONTINUUM_OFFSET
+
+# A rough size for LZW-compressed movie frames, in bytes per pixel. Mostly
+# blank (thresholded) frames compress far better than this, so it errs big.
+GIF_BYTES_PER_PIXEL = 0.5
+
+Job = namedtuple('Job', ['cube', 'name', 'redshift', 'center', 'channels',
+                         'read_bytes', 'peak_bytes', 'frames', 'output_bytes',
+                         'problems'])
+
+
+def plan_job(cube, name, redshift, restwav, frames=30, scalefactor=2.0, contsub=False, slab=False, precision='float32', velocity_grid=None):
+    '''Work out what making one movie will take, from the cube's header alone.
+
+    channels is the (start, stop) window of the movie. read_bytes is what
+    gets read from the cube, and peak_bytes an estimate of the most memory
+    the movie needs at once: every rendered frame is kept (frames x RGB at
+    the scaled size), plus the canvas and the reused float32 and byte
+    buffers for the frame being made, plus the whole window if it's read in
+    one go (slab=True, as for moment and channel maps), held as float32 or
+    with precision='uint16', two bytes a pixel. problems lists why the job
+    can't be done, if it can't. With a velocity_grid (low, high, step) in
+    km/s, the movie has a frame per grid step and reads the channels the
+    grid covers.
+    '''
+
+    problems = []
+    center = restwav * (1 + redshift) if redshift is not None else None
+
+    try:
+        shape, itemsize, header = read_header(cube)
+    except (OSError, KeyError, ValueError) as error:
+        return Job(cube, name, redshift, center, None, 0, 0, 0, 0,
+                   ["can't read the header: {}".format(error)])
+
+    number_of_channels, ny, nx = shape
+
+    if redshift is None:
+        return Job(cube, name, redshift, center, None, 0, 0, 0, 0,
+                   ["no redshift"])
+
+    wavelength = wavelength_array(header, number_of_channels)
+    if not wavelength.min() <= center <= wavelength.max():
+        problems.append("line at {:.1f} A is outside the cube ({:.1f}-{:.1f} A)".format(
+            center, wavelength.min(), wavelength.max()))
+
+    center_channel = int(np.abs(wavelength - center).argmin())
+    start = center_channel - frames
+    stop = center_channel + frames
+    number_of_frames = 2 * frames
+
+    if velocity_grid is not None:
+        try:
+            grid = grid_velocities(*velocity_grid)
+            number_of_frames = len(grid)
+            positions = grid_channels(velocity_array(header, wavelength, center), grid)
+            start = int(np.floor(positions.min()))
+            stop = min(int(np.floor(positions.max())) + 2, number_of_channels)
+        except ValueError as error:
+            problems.append(str(error))
+    elif start < 0 or stop > number_of_channels:
+        problems.append("the +/-{} frame window [{}, {}) leaves the cube's {} channels".format(
+            frames, start, stop, number_of_channels))
+    if contsub is True and center_channel - CONTINUUM_OFFSET < 0:
+        problems.append("the continuum channel ({}) is before the start of the cube".format(
+            center_channel - CONTINUUM_OFFSET))
+
+    plane = ny * nx * itemsize
+    read_bytes = (stop - start) * plane + (plane if contsub is True else 0)
+
+    frame_pixels = int(round(ny * scalefactor)) * int(round(nx * scalefactor))
+    # Three float32 images, three masks, the colormap indices and the RGB
+    peak_bytes = number_of_frames * frame_pixels * 3 + frame_pixels * 4 + ny * nx * (3 * 4 + 3 + 1 + 3)
+    if slab is True:
+        peak_bytes += read_bytes // itemsize * (2 if precision == 'uint16' else 4)
+        # The continuum channel is kept float32 either way
+        if precision == 'uint16' and contsub is True:
+            peak_bytes += ny * nx * 2
+
+    output_bytes = int(number_of_frames * frame_pixels * GIF_BYTES_PER_PIXEL)
+
+    return Job(cube, name, redshift, center, (start, stop), read_bytes,
+               peak_bytes, number_of_frames, output_bytes, problems)
+
+
+def plan_batch(name_dictionary, redshift_dictionary, restwav, failures=None, **options):
+    '''Plan a movie for every {filename: name}, with redshifts from
+    redshift_dictionary. failures are {filename: reason} for files that
+    didn't even get a name. Takes the same options as plan_job.'''
+
+    jobs = []
+
+    for cube, name in name_dictionary.items():
+        jobs.append(plan_job(cube, name, redshift_dictionary.get(name), restwav, **options))
+
+    if failures is not None:
+        for cube, reason in failures.items():
+            jobs.append(Job(cube, None, None, None, None, 0, 0, 0, 0, [reason]))
+
+    return jobs
+
+
+def pack_jobs(jobs, memory_limit):
+    '''Group jobs that can run together within memory_limit bytes.
+
+    First-fit decreasing: the biggest jobs are placed first, each into the
+    first group that still has room. Jobs that need more than the limit on
+    their own get a group to themselves. Impossible jobs are left out.
+    '''
+
+    groups = []
+    room = []
+
+    for job in sorted(jobs, key=lambda job: job.peak_bytes, reverse=True):
+        if len(job.problems) > 0:
+            continue
+        for i in range(len(groups)):
+            if job.peak_bytes <= room[i]:
+                groups[i].append(job)
+                room[i] -= job.peak_bytes
+                break
+        else:
+            groups.append([job])
+            room.append(memory_limit - job.peak_bytes)
+
+    return groups
+
+
+def print_plan(jobs, memory_limit=None):
+    '''Print a table of jobs and their costs, the impossible ones, and how
+    they'd be packed into memory_limit bytes'''
+
+    def mb(n):
+        return "{:.1f} MB".format(n / 1e6)
+
+    print("\n\n ===== PLAN ====\n")
+
+    good = [job for job in jobs if len(job.problems) == 0]
+    bad = [job for job in jobs if len(job.problems) > 0]
+
+    for job in good:
+        print("{}: z={:.4f}, channels {}-{}, {} frames, reads {}, peak {}, GIF ~{}".format(
+            job.name, job.redshift, job.channels[0], job.channels[1] - 1, job.frames,
+            mb(job.read_bytes), mb(job.peak_bytes), mb(job.output_bytes)))
+
+    print("\n{} movies to make: {} to read, ~{} of GIFs.".format(
+        len(good), mb(sum(job.read_bytes for job in good)),
+        mb(sum(job.output_bytes for job in good))))
+
+    if len(bad) > 0:
+        print("\n{} can't be made:".format(len(bad)))
+        for job in bad:
+            print("    {} ({}): {}".format(job.name or "?", job.cube.split("/")[-1],
+                                        "; ".join(job.problems)))
+
+    if memory_limit is not None and len(good) > 0:
+        groups = pack_jobs(good, memory_limit)
+        print("\nIn {} of memory, they'd pack into {} groups:".format(
+            mb(memory_limit), len(groups)))
+        for group in groups:
+            print("    {} ({})".format(", ".join(job.name for job in group),
+                                       mb(sum(job.peak_bytes for job in group))))
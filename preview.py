@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+import io
+import html
+import json
+import shlex
+
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from matplotlib.image import imsave
+from matplotlib import cm
+
+from cubeio import open_cube
+from musemovie import MovieFrames
+
+# The settings that can be tuned from the browser, and their defaults
+DEFAULT_SETTINGS = {'thresh': None, 'vmin': None, 'vmax': None,
+                    'linear': False, 'contsub': False, 'white': False}
+
+
+class Preview(object):
+    '''Single frames of one cube, rendered on demand with whatever settings
+    are asked for.
+
+    The cube is opened once and stays memory-mapped, so a frame only reads
+    its own channel (and the continuum channel, with contsub). Frames are
+    rendered at preview_scale and kept as PNGs in an LRU cache of
+    cache_size frames, keyed by the settings and the frame, so going back
+    to settings you've tried before is instant. scalefactor is only for
+    the exported command.
+    '''
+
+    def __init__(self, cube, redshift=0.0, restwav=6563.0, name=None, frames=30, scalefactor=3.0, preview_scale=1.0, cache_size=512, cache_dir=None, settings=None):
+
+        self.cube = cube
+        self.redshift = redshift
+        self.restwav = restwav
+        self.name = name
+        self.frames = frames
+        self.scalefactor = scalefactor
+        self.preview_scale = preview_scale
+        self.cache_size = cache_size
+
+        self.data, self.header = open_cube(cube, cache_dir=cache_dir)
+        self.center = restwav * (1 + redshift)
+
+        self.settings = dict(DEFAULT_SETTINGS)
+        if settings is not None:
+            self.settings.update(settings)
+
+        # A few movies (one per recent set of settings), so their figures
+        # and buffers are reused while a setting is being dragged about
+        self._movies = OrderedDict()
+        self._frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.velocities = self.movie(self.settings).velocities
+
+    def __len__(self):
+        return len(self.velocities)
+
+    def movie(self, settings):
+        '''The MovieFrames for these settings'''
+
+        key = tuple(sorted(settings.items()))
+        if key in self._movies:
+            self._movies.move_to_end(key)
+            return self._movies[key]
+
+        movie = MovieFrames((self.data, self.header), self.center,
+                            frames=self.frames, thresh=settings['thresh'],
+                            scalefactor=self.preview_scale,
+                            vmin=settings['vmin'], vmax=settings['vmax'],
+                            contsub=settings['contsub'], cmap=cm.plasma,
+                            background_color='white' if settings['white'] else 'black',
+                            linear=settings['linear'])
+
+        self._movies[key] = movie
+        if len(self._movies) > 4:
+            self._movies.popitem(last=False)
+
+        return movie
+
+    def frame(self, index, settings):
+        '''One frame with these settings, as PNG bytes'''
+
+        self.settings = settings
+
+        key = (tuple(sorted(settings.items())), index)
+        if key in self._frames:
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return self._frames[key]
+
+        self.misses += 1
+        movie = self.movie(settings)
+        # The PNG is what's kept
+        image = movie.frame(index, keep=False).image
+
+        buffer = io.BytesIO()
+        imsave(buffer, image, format='png')
+        png = buffer.getvalue()
+
+        self._frames[key] = png
+        if len(self._frames) > self.cache_size:
+            self._frames.popitem(last=False)
+
+        return png
+
+    def command(self, settings=None):
+        '''The musemovie.py command that makes the full movie with these settings'''
+
+        if settings is None:
+            settings = self.settings
+
+        arguments = ['python', 'musemovie.py', self.cube, '-z', repr(self.redshift),
+                     '-r', repr(self.restwav)]
+        if self.name is not None:
+            arguments += ['-n', self.name]
+        arguments += ['-f', str(self.frames), '-s', repr(self.scalefactor)]
+
+        for option, flag in (('thresh', '-t'), ('vmin', '--vmin'), ('vmax', '--vmax')):
+            if settings[option] is not None:
+                arguments += [flag, repr(settings[option])]
+        for option, flag in (('linear', '--linear'), ('contsub', '--contsub'), ('white', '--white')):
+            if settings[option] is True:
+                arguments.append(flag)
+
+        return ' '.join(shlex.quote(argument) for argument in arguments)
+
+    def manifest(self, settings=None):
+        '''The settings, with what they apply to, as a dictionary'''
+
+        if settings is None:
+            settings = self.settings
+
+        return dict(cube=self.cube, name=self.name, redshift=self.redshift,
+                    restwav=self.restwav, frames=self.frames,
+                    scalefactor=self.scalefactor, **settings)
+
+
+def parse_settings(query):
+    '''Settings from a parsed query string. Blank or missing numbers mean
+    None (automatic), and flags are 1 or 0.'''
+
+    settings = dict(DEFAULT_SETTINGS)
+
+    for option in ('thresh', 'vmin', 'vmax'):
+        value = query.get(option, [''])[0].strip()
+        settings[option] = float(value) if value != '' else None
+    for option in ('linear', 'contsub', 'white'):
+        settings[option] = query.get(option, ['0'])[0] == '1'
+
+    return settings
+
+
+PAGE = '''<!DOCTYPE html>
+<html><head><title>musemovie: {title}</title>
+<style>
+body {{ font-family: sans-serif; background: #222; color: #ddd; }}
+label {{ margin-right: 1em; }}
+input[type=number] {{ width: 6em; }}
+#frame {{ width: 40em; image-rendering: pixelated; }}
+#command {{ font-family: monospace; background: #111; padding: 0.5em; user-select: all; }}
+</style></head>
+<body>
+<h3>{title}</h3>
+<div><img id="frame"></div>
+<div>
+<input id="index" type="range" min="0" max="{last}" value="{middle}" style="width: 40em">
+<span id="velocity"></span>
+</div>
+<div>
+<label>thresh <input id="thresh" type="number" step="any" value="{thresh}"></label>
+<label>vmin <input id="vmin" type="number" step="any" value="{vmin}"></label>
+<label>vmax <input id="vmax" type="number" step="any" value="{vmax}"></label>
+<label><input id="linear" type="checkbox" {linear}> linear</label>
+<label><input id="contsub" type="checkbox" {contsub}> contsub</label>
+<label><input id="white" type="checkbox" {white}> white</label>
+</div>
+<p>Make the full movie with:</p>
+<div id="command"></div>
+<script>
+var velocities = {velocities};
+function query() {{
+  var q = [];
+  ['thresh', 'vmin', 'vmax'].forEach(function (id) {{
+    q.push(id + '=' + encodeURIComponent(document.getElementById(id).value));
+  }});
+  ['linear', 'contsub', 'white'].forEach(function (id) {{
+    q.push(id + '=' + (document.getElementById(id).checked ? 1 : 0));
+  }});
+  return q.join('&');
+}}
+function update() {{
+  var index = document.getElementById('index').value;
+  document.getElementById('frame').src = '/frame?index=' + index + '&' + query();
+  document.getElementById('velocity').textContent =
+    (velocities[index] >= 0 ? '+' : '') + velocities[index].toFixed(0) + ' km/s';
+  fetch('/export?' + query()).then(function (r) {{ return r.json(); }})
+    .then(function (e) {{ document.getElementById('command').textContent = e.command; }});
+}}
+document.querySelectorAll('input').forEach(function (input) {{
+  input.addEventListener('input', update);
+}});
+update();
+</script>
+</body></html>
+'''
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    '''/ is the page, /frame?index=N&... a PNG of one frame, and
+    /export?... the command and settings as JSON'''
+
+    def do_GET(self):
+
+        preview = self.server.preview
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+
+        try:
+            if url.path == '/':
+                self.send(200, 'text/html', page(preview).encode())
+            elif url.path == '/frame':
+                index = int(query.get('index', ['0'])[0])
+                if not 0 <= index < len(preview):
+                    raise ValueError("No frame {}; there are {}.".format(index, len(preview)))
+                self.send(200, 'image/png', preview.frame(index, parse_settings(query)))
+            elif url.path == '/export':
+                settings = parse_settings(query)
+                export = dict(command=preview.command(settings),
+                              manifest=preview.manifest(settings))
+                self.send(200, 'application/json', json.dumps(export).encode())
+            else:
+                self.send(404, 'text/plain', b'Not found')
+        except ValueError as error:
+            self.send(400, 'text/plain', str(error).encode())
+
+    def send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Every slider step is a request, so keep quiet about them
+        pass
+
+
+def page(preview):
+    '''The HTML page, with the current settings filled in'''
+
+    settings = preview.settings
+
+    def number(value):
+        return '' if value is None else repr(value)
+
+    def checked(value):
+        return 'checked' if value is True else ''
+
+    return PAGE.format(title=html.escape(preview.name or preview.cube), last=len(preview) - 1,
+                       middle=len(preview) // 2, thresh=number(settings['thresh']),
+                       vmin=number(settings['vmin']), vmax=number(settings['vmax']),
+                       linear=checked(settings['linear']),
+                       contsub=checked(settings['contsub']),
+                       white=checked(settings['white']),
+                       velocities=json.dumps([round(float(v), 1) for v in preview.velocities]))
+
+
+def serve(preview, port=8000, host='127.0.0.1'):
+    '''Serve a Preview until Ctrl-C, then print the command for the last
+    settings that were looked at'''
+
+    server = HTTPServer((host, port), PreviewHandler)
+    server.preview = preview
+
+    print("Previewing {} at http://{}:{}/ (Ctrl-C to stop)".format(preview.cube, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    print("\nRendered {} frames, {} more from the cache.".format(preview.misses, preview.hits))
+    print("Make the full movie with:\n\n    {}\n".format(preview.command()))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import os
+import csv
+import warnings
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from matplotlib.colors import Normalize
+from matplotlib.image import imsave
+from matplotlib import cm
+
+from cubeio import open_cube, wavelength_array
+from overlay import Overlay
+
+
+def thumbnail(cube, center=None, samples=5, stride=4, size=128, cache_dir=None):
+    '''A quick look at a cube from a handful of strided channels.
+
+    With a line center (in observed Angstroms), samples channels stride
+    apart around it are read; without one, they're spread across the whole
+    cube for a rough white light image. Their mean is block-averaged down
+    to at most size pixels on a side. Returns (image, channels).
+    '''
+
+    data, header = open_cube(cube, cache_dir=cache_dir)
+    number_of_channels = data.shape[0]
+
+    if center is None:
+        channels = np.linspace(0, number_of_channels - 1, samples).astype(int)
+    else:
+        wavelength = wavelength_array(header, number_of_channels)
+        middle = int(np.abs(wavelength - center).argmin())
+        channels = middle + stride * (np.arange(samples) - samples // 2)
+        channels = np.unique(np.clip(channels, 0, number_of_channels - 1))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        image = np.nanmean(np.array([data[channel, :, :] for channel in channels],
+                                    dtype=np.float32), axis=0)
+
+    # Block average, padding the edges out with NaN to a whole block
+    factor = int(np.ceil(max(image.shape) / float(size)))
+    if factor > 1:
+        ny, nx = image.shape
+        padded = np.full((-(-ny // factor) * factor, -(-nx // factor) * factor),
+                         np.nan, dtype=np.float32)
+        padded[:ny, :nx] = image
+        blocks = padded.reshape(padded.shape[0] // factor, factor,
+                                padded.shape[1] // factor, factor)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            image = np.nanmean(blocks, axis=(1, 3))
+
+    return image, channels
+
+
+def colorize(image, size, cmap=cm.plasma):
+    '''A (size, size, 3) uint8 tile of a thumbnail, stretched between its 1st
+    and 99.5th percentiles and centered on a black square'''
+
+    tile = np.zeros((size, size, 3), dtype=np.uint8)
+
+    finite = image[np.isfinite(image)]
+    if len(finite) == 0:
+        return tile
+
+    norm = Normalize(*np.percentile(finite, [1, 99.5]), clip=True)
+    rgb = (cmap.with_extremes(bad='black')(norm(np.ma.masked_invalid(image)))[:, :, :3] * 255).astype(np.uint8)
+
+    # Images have their origin at the bottom left
+    rgb = rgb[::-1]
+    top = (size - rgb.shape[0]) // 2
+    left = (size - rgb.shape[1]) // 2
+    tile[top:top + rgb.shape[0], left:left + rgb.shape[1]] = rgb
+
+    return tile
+
+
+def contact_sheet(name_dictionary, output, centers=None, samples=5, stride=4, size=128, workers=8, cache_dir=None):
+    '''Thumbnail every cube in {filename: target name}, and tile them.
+
+    centers maps filenames to observed line centers; cubes without one get
+    a white light thumbnail. Cubes are read concurrently, since it's nearly
+    all waiting on the disk. Writes output.png (the sheet), output.csv (an
+    index of which tile is which cube) and a PNG per cube in output_thumbs/.
+    Returns the sheet, or None (writing nothing) if there are no cubes.
+    '''
+
+    if centers is None:
+        centers = {}
+
+    filenames = sorted(name_dictionary, key=lambda f: name_dictionary[f])
+    if len(filenames) == 0:
+        print("No cubes found, so there's no contact sheet to make.")
+        return None
+
+    def look(filename):
+        try:
+            return thumbnail(filename, center=centers.get(filename), samples=samples,
+                             stride=stride, size=size, cache_dir=cache_dir)
+        except (OSError, KeyError, ValueError) as error:
+            print("Couldn't read {}: {}".format(filename, error))
+            return None, []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        thumbnails = list(executor.map(look, filenames))
+
+    thumbs_dir = output + '_thumbs'
+    if not os.path.exists(thumbs_dir):
+        os.makedirs(thumbs_dir)
+
+    columns = int(np.ceil(np.sqrt(len(filenames))))
+    rows = int(np.ceil(len(filenames) / float(columns)))
+    sheet = np.zeros((rows * size, columns * size, 3), dtype=np.uint8)
+
+    # One overlay for every tile, so each glyph is only drawn once
+    overlay = Overlay((size, size))
+    max_chars = max(1, (size - 2 * overlay.margin) // overlay.glyphs.width)
+
+    with open(output + '.csv', 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['tile', 'row', 'column', 'file', 'name', 'center', 'channels', 'thumbnail'])
+
+        for tile_number, (filename, (image, channels)) in enumerate(zip(filenames, thumbnails)):
+            row, column = divmod(tile_number, columns)
+            name = name_dictionary[filename]
+
+            thumb_name = ''
+            if image is not None:
+                tile = overlay.composite(colorize(image, size), name[:max_chars])
+                thumb_name = os.path.join(thumbs_dir, os.path.splitext(
+                    os.path.basename(filename))[0] + '.png')
+                imsave(thumb_name, tile)
+                sheet[row * size:(row + 1) * size, column * size:(column + 1) * size] = tile
+
+            center = centers.get(filename)
+            writer.writerow([tile_number, row, column, filename, name,
+                             '' if center is None else '{:.2f}'.format(center),
+                             ';'.join(str(c) for c in channels), thumb_name])
+
+    imsave(output + '.png', sheet)
+
+    return sheet
@@ -0,0 +1,13 @@
+import pytest
+
+from cubeio import grid_velocities
+
+
+def test_grid_velocities_includes_both_ends():
+    assert list(grid_velocities(-100, 100, 50)) == [-100, -50, 0, 50, 100]
+
+
+@pytest.mark.parametrize('low, high, step', [(-100, 100, 0), (-100, 100, -25), (100, -100, 25)])
+def test_grid_velocities_rejects_an_empty_grid(low, high, step):
+    with pytest.raises(ValueError):
+        grid_velocities(low, high, step)
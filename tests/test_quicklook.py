@@ -0,0 +1,21 @@
+import os
+
+from musemovie import quicklook_main
+from quicklook import contact_sheet
+
+
+def test_contact_sheet_of_no_cubes(tmp_path):
+    output = str(tmp_path / 'sheet')
+
+    assert contact_sheet({}, output) is None
+    assert not os.path.exists(output + '.png')
+    assert not os.path.exists(output + '.csv')
+
+
+def test_quicklook_of_an_empty_directory(tmp_path, capsys):
+    output = str(tmp_path / 'sheet')
+
+    quicklook_main([str(tmp_path), '-o', output])
+
+    assert "No cubes found" in capsys.readouterr().out
+    assert not os.path.exists(output + '.png')
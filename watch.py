@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import os
+import time
+import fnmatch
+
+
+class DirectoryWatcher(object):
+    '''New and changed files in a directory, once they've finished arriving.
+
+    The directory is only ever listed and stat'ed, never opened, so a scan
+    is cheap however many cubes are in it. A file is handed out once its
+    size and mtime are the same on two scans in a row (so it's not still
+    being copied in), and again only if it changes after that. Files that
+    are already there when the watcher is made count as handled, unless
+    known says otherwise:
+
+        watcher = DirectoryWatcher('/data/MUSE/')
+        ...  # make movies of everything there already
+        for filelist in watcher:
+            ...  # new or changed, complete files
+
+    With the optional inotify_simple package (Linux), the watcher sleeps
+    until the directory changes rather than scanning every interval. It
+    still rescans every interval while anything is waiting to settle.
+    '''
+
+    def __init__(self, directory, pattern='*.fits', interval=30.0, known=None):
+
+        self.directory = directory
+        self.pattern = pattern
+        self.interval = interval
+
+        # path -> (size, mtime), for files that have already been handed out,
+        # and for ones that have been seen but might still be arriving. By
+        # default, whatever is there already counts as handled.
+        self.known = dict(known) if known is not None else self.snapshot()
+        self.pending = {}
+
+        self._inotify = None
+        try:
+            from inotify_simple import INotify, flags
+            self._inotify = INotify()
+            self._inotify.add_watch(directory, flags.CREATE | flags.MODIFY |
+                                    flags.CLOSE_WRITE | flags.MOVED_TO)
+        except (ImportError, OSError):
+            self._inotify = None
+
+    def snapshot(self):
+        '''{path: (size, mtime)} of every matching file in the directory'''
+
+        files = {}
+        for entry in os.scandir(self.directory):
+            if fnmatch.fnmatch(entry.name, self.pattern) and entry.is_file():
+                stat = entry.stat()
+                files[os.path.join(self.directory, entry.name)] = (stat.st_size, stat.st_mtime)
+
+        return files
+
+    def poll(self):
+        '''Files that are new or changed, and haven't changed since the last poll'''
+
+        current = self.snapshot()
+        ready = []
+
+        for path, stat in current.items():
+            if self.known.get(path) == stat:
+                continue
+            if self.pending.get(path) == stat:
+                ready.append(path)
+                self.known[path] = stat
+                del self.pending[path]
+            else:
+                self.pending[path] = stat
+
+        # Forget anything that was deleted before it settled
+        for path in list(self.pending):
+            if path not in current:
+                del self.pending[path]
+
+        return sorted(ready)
+
+    def wait(self):
+        '''Block until it's worth scanning again'''
+
+        if self._inotify is None:
+            time.sleep(self.interval)
+        elif len(self.pending) > 0:
+            # Something is still arriving: look again after an interval,
+            # even if nothing else happens
+            time.sleep(self.interval)
+            self._inotify.read(timeout=0)
+        else:
+            self._inotify.read()
+
+    def __iter__(self):
+        while True:
+            self.wait()
+            ready = self.poll()
+            if len(ready) > 0:
+                yield ready